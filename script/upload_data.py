@@ -23,7 +23,13 @@
 #              cached on the webserver, the script will reload this cache data
 #              using webserver REST URLs. The cache data can also be updated by
 #              passing a command line arg of either 'fill' (to load the cache) or
-#              'reload' (to flush then load the cache).
+#              'reload' (to flush then load the cache). 'cache fill' and
+#              'cache reload' do the same without looking for new files, and
+#              only load the modules needed to do so.
+#
+#              'validate [folder]' checks the new files (or those in the given
+#              folder) with the upload parsers, in parallel, and reports any
+#              problems without touching the database, S3 or the files.
 #
 #
 #              If an error occurs during processing, a notification email is sent
@@ -35,6 +41,9 @@
 # Created:     07/10/2013
 #-------------------------------------------------------------------------------
 
+import time
+script_start_time = time.time()
+
 import os
 import ConfigParser
 from datetime import date, timedelta, datetime
@@ -44,21 +53,55 @@ import smtplib
 from email.mime.text import MIMEText
 import re
 import codecs
+import gzip
+import bz2
+import mmap
+import multiprocessing
 import base64
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
-import time
+from array import array
+import threading
+import shutil
+import zipfile
+import json
+import hashlib
+import cStringIO
 
 import MySQLdb
-from PIL import Image
-from PIL import ExifTags
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
-import xlrd
+# PIL, boto and xlrd are slow to import, so they're imported by the functions
+# that use them (xlrd through get_xlrd()), and aren't loaded at all by cache
+# only runs
 import httplib
+import socket
+import urllib
+import Queue
+# scandir lists directories with file sizes and times in one pass, much faster
+# than os.walk and os.stat over a network share. It's built into Python 3.5+,
+# and available for Python 2 as the scandir package.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 log = logging.getLogger('Springs Uploader')
-notification_msg = '1000 Springs data upload results'
+NOTIFICATION_HEADER = '1000 Springs data upload results'
+notification_msg = NOTIFICATION_HEADER
 new_files_dir = None
+staging_dir = None
+db_pool = None
+xlrd_module = None
+
+# Returns the xlrd module, importing it the first time it's needed. Worksheet
+# functions called for every cell use this rather than an import statement.
+def get_xlrd():
+    global xlrd_module
+    if xlrd_module is None:
+        import xlrd
+        xlrd_module = xlrd
+    return xlrd_module
 
 def main():
 
@@ -66,67 +109,64 @@ def main():
     db_conn = None
     log_file = None
     global new_files_dir
+    global staging_dir
+    global db_pool
     try:
         config = load_config('upload_data.cfg')
         log_file = init_logging(config)
         log.info('upload_data.py '+str(sys.argv))
-        db_conn = db_connect(config)
-        new_files_dir = get_new_files_dir(config)
-
-        feature_files, sample_files, image_files, other_xls_files, thumbsdb_cruft_files, dna_sequence_files = find_files(new_files_dir)
-
-        f_files_uploaded, f_files_error = process_feature_files(db_conn, feature_files)
-        add_upload_summary('Feature',  f_files_uploaded, f_files_error, [])
-
-        s_files_uploaded, s_files_error =  process_sample_files(db_conn, sample_files)
-        add_upload_summary('Sample', s_files_uploaded, s_files_error, [])
-
-        g_files_uploaded, g_files_error, g_files_skipped = process_geochem_files(db_conn, other_xls_files)
-        t_files_uploaded, t_files_error, t_files_skipped = process_taxonomy_files(db_conn, other_xls_files)
-        xls_files_skipped = [f for f in g_files_skipped if f in t_files_skipped]
-        add_upload_summary('Geochemistry', g_files_uploaded, g_files_error, xls_files_skipped)
-        add_upload_summary('Taxonomy', t_files_uploaded, t_files_error, [])
-
-        d_files_uploaded, d_files_error = process_dna_sequence_files(db_conn, dna_sequence_files)
-        add_upload_summary('DNA sequence', d_files_uploaded, d_files_error, [])
-
-        i_files_uploaded, i_files_error, i_files_skipped, i_files_to_archive = process_image_files(config, db_conn, image_files)
-        add_upload_summary('Image',  i_files_uploaded, i_files_error, i_files_skipped)
-
-        move_files(f_files_uploaded + s_files_uploaded + i_files_uploaded + i_files_to_archive + g_files_uploaded + t_files_uploaded + d_files_uploaded, get_archive_dir(config))
-        move_files(f_files_error + s_files_error + i_files_error + g_files_error + t_files_error + d_files_error, get_error_dir(config))
-
-        if feature_files or sample_files or image_files or other_xls_files or dna_sequence_files:
-            send_upload_notification(config)
+        if len(sys.argv) > 1 and sys.argv[1].lower() == 'validate':
+            # nothing is read from or written to the database
+            if len(sys.argv) > 2:
+                new_files_dir = os.path.normpath(sys.argv[2])
+            else:
+                new_files_dir = get_new_files_dir(config)
+            problem_count = validate_files(config, new_files_dir)
+            if len(sys.argv) == 2:
+                unmount_data_share(config)
+            # exit with a non-zero status, so scripts can hold back files with problems
+            return 1 if problem_count > 0 else 0
+
+        cache_command = get_cache_command(sys.argv)
+        db_pool = new_db_pool(config)
+        db_conn = borrow_db_connection(db_pool)
+        log.info('Started in %dms' % ((time.time() - script_start_time) * 1000))
+
+        if cache_command['cache_only']:
+            update_website_data(config, db_conn, new_taxonomy_changes(), set(), cache_command)
+            return
 
-        process_thumbsdb_cruft_files(thumbsdb_cruft_files)
+        new_files_dir = get_new_files_dir(config)
+        staging_dir = get_staging_dir(config)
+        if len(sys.argv) > 1 and sys.argv[1].lower() == 'watch':
+            # connections are borrowed for each upload
+            return_db_connection(db_pool, db_conn)
+            db_conn = None
+            watch_new_files(config, new_files_dir, log_file.baseFilename)
+            return
+
+        inbox_manifest_file = get_inbox_manifest_file(config)
+        inbox_manifest = load_inbox_manifest(inbox_manifest_file)
+        new_file_paths = scan_new_files(db_conn, new_files_dir, inbox_manifest)
+        upload_leases = claim_upload_leases(config, new_file_paths)
+        share_paths = {}
+        try:
+            local_file_paths, share_paths, file_hashes = stage_files(config, upload_leases['files'])
+            taxonomy_changes, s_sample_numbers = process_files(config, classify_files(local_file_paths),
+                share_paths=share_paths, staged_hashes=file_hashes)
+        finally:
+            remove_staged_files(share_paths)
+            release_upload_leases(upload_leases)
+        update_inbox_manifest(inbox_manifest, upload_leases['files'])
+        # files claimed by another uploader are looked at again next time, in case it fails
+        for f in new_file_paths:
+            if f not in upload_leases['claimed']:
+                inbox_manifest.pop(f, None)
+        save_inbox_manifest(inbox_manifest_file, inbox_manifest)
 
         unmount_data_share(config)
 
-        # Update taxonomy caches if necessary
-        host = config.get('Website', 'host')
-        clear_tax_summary_cache = len(t_files_uploaded) > 0 or (len(sys.argv) > 1 and sys.argv[1].lower() == 'reload')
-        clear_tax_overview_cache = clear_tax_summary_cache or len(s_files_uploaded) > 0
-        fill_caches = len(sys.argv) > 1 and sys.argv[1].lower() == 'fill'
-
-        if clear_tax_overview_cache:
-            http_get(host, '/clearTaxonomyOverviewCache')
-        if fill_caches or clear_tax_overview_cache:
-            init_taxonomy_overview_cache(host, db_conn)
-
-        if clear_tax_summary_cache:
-            http_get(host, '/clearTaxonomyCache')
-        if fill_caches or clear_tax_summary_cache:
-            init_taxonomy_summary_cache(host, db_conn)
-
-        if clear_tax_overview_cache or clear_tax_summary_cache or fill_caches:
-            msg = 'Cache update complete on '+host
-            send_email(
-                msg,
-                "1000 Springs cache update complete",
-                'cache_refreshed_to_csv',
-                config
-                )
+        update_website_data(config, db_conn, taxonomy_changes, s_sample_numbers, cache_command)
 
     except Exception as e:
         upload_error = True
@@ -141,58 +181,941 @@ def main():
         log.info('upload_tablet_data.py exiting\n')
         if db_conn is not None:
             db_conn.close()
+        if db_pool is not None:
+            close_db_pool(db_pool)
         if log_file is not None:
             log_file.close()
 
+    return 1 if upload_error else 0
+
+
+# Upload stages, and the stages each must wait for. Stages which don't depend
+# on each other are run at the same time.
+UPLOAD_STAGE_DEPENDENCIES = {
+    'feature': [],
+    'sample': ['feature'],
+    'geochem': ['sample'],
+    # geochemistry and taxonomy uploads both add any samples missing from the
+    # database, so they're run one after the other
+    'taxonomy': ['geochem'],
+    'dna_sequence': ['taxonomy'],
+    'image': ['sample']
+}
+
+# files: tuple of lists of files by type, as returned by classify_files()
+# s3_bucket: S3 bucket to upload images to, or None to connect to the configured bucket
+# share_paths: dictionary in the form {local copy: file on the share} of files
+#              staged by stage_files(), or None if the files weren't staged
+# staged_hashes: dictionary in the form {local copy: SHA-1 hash} of the hashes
+#                of the staged files worked out while copying them, or None
+#
+# Runs each file type's upload stage, moves the files processed to the archive
+# or error directory and sends the upload notification.
+# Returns a tuple of (taxonomy changes in the form returned by new_taxonomy_changes(),
+# set of sample numbers uploaded)
+def process_files(config, files, s3_bucket=None, share_paths=None, staged_hashes=None):
+    feature_files, sample_files, image_files, other_xls_files, thumbsdb_cruft_files, dna_sequence_files = files
+
+    # Files already uploaded with exactly the same content are archived without being processed again
+    file_hashes = {}
+    duplicate_files = {}
+    if use_upload_ledger(config):
+        file_hashes = get_file_hashes(feature_files + sample_files + image_files.keys() + other_xls_files + dna_sequence_files,
+            staged_hashes)
+        db_conn = borrow_db_connection(db_pool)
+        try:
+            duplicate_files = find_uploaded_files(db_conn, file_hashes)
+        finally:
+            return_db_connection(db_pool, db_conn)
+        if len(duplicate_files) > 0:
+            feature_files = [f for f in feature_files if f not in duplicate_files]
+            sample_files = [f for f in sample_files if f not in duplicate_files]
+            image_files = dict([(f, d) for f, d in image_files.iteritems() if f not in duplicate_files])
+            other_xls_files = [f for f in other_xls_files if f not in duplicate_files]
+            dna_sequence_files = [f for f in dna_sequence_files if f not in duplicate_files]
+
+    def process_unattached_dna_sequence_files(stage_db_conn, results):
+        # DNA sequence files already loaded along with their taxonomy file don't need a separate update
+        d_files_attached_names = [f[0] for f in results['taxonomy'][4]]
+        return process_dna_sequence_files(config, stage_db_conn, [f for f in dna_sequence_files if f not in d_files_attached_names])
+
+    results, elapsed = run_stages({
+        'feature': lambda stage_db_conn, results: process_feature_files(stage_db_conn, feature_files),
+        'sample': lambda stage_db_conn, results: process_sample_files(stage_db_conn, sample_files),
+        'geochem': lambda stage_db_conn, results: process_geochem_files(stage_db_conn, other_xls_files),
+        'taxonomy': lambda stage_db_conn, results: process_taxonomy_files(config, stage_db_conn, other_xls_files, dna_sequence_files),
+        'dna_sequence': process_unattached_dna_sequence_files,
+        'image': lambda stage_db_conn, results: process_image_files(config, stage_db_conn, image_files, s3_bucket)
+    }, UPLOAD_STAGE_DEPENDENCIES)
+
+    f_files_uploaded, f_files_error = results['feature']
+    add_upload_summary('Feature',  f_files_uploaded, f_files_error, [], elapsed['feature'])
+
+    s_files_uploaded, s_files_error, s_sample_numbers = results['sample']
+    add_upload_summary('Sample', s_files_uploaded, s_files_error, [], elapsed['sample'])
+
+    g_files_uploaded, g_files_error, g_files_skipped = results['geochem']
+    t_files_uploaded, t_files_error, t_files_skipped, taxonomy_changes, d_files_attached = results['taxonomy']
+    xls_files_skipped = [f for f in g_files_skipped if f in t_files_skipped]
+    add_upload_summary('Geochemistry', g_files_uploaded, g_files_error, xls_files_skipped, elapsed['geochem'])
+    add_upload_summary('Taxonomy', t_files_uploaded, t_files_error, [], elapsed['taxonomy'])
+
+    d_files_uploaded, d_files_error, d_otu_match_counts = results['dna_sequence']
+    d_files_uploaded += [[f[0], f[1]] for f in d_files_attached]
+    d_otu_match_counts += d_files_attached
+    add_upload_summary('DNA sequence', d_files_uploaded, d_files_error, [], elapsed['dna_sequence'])
+    add_dna_sequence_match_summary(d_otu_match_counts)
+
+    i_files_uploaded, i_files_error, i_files_skipped, i_files_to_archive = results['image']
+    add_upload_summary('Image',  i_files_uploaded, i_files_error, i_files_skipped, elapsed['image'])
+
+    add_duplicate_file_summary(duplicate_files)
+
+    if len(file_hashes) > 0:
+        db_conn = borrow_db_connection(db_pool)
+        try:
+            record_uploaded_files(db_conn, file_hashes, [
+                ('feature', f_files_uploaded), ('sample', s_files_uploaded), ('geochem', g_files_uploaded),
+                ('taxonomy', t_files_uploaded), ('dna_sequence', d_files_uploaded), ('image', i_files_uploaded)])
+        finally:
+            return_db_connection(db_pool, db_conn)
+
+    archive_files(config, f_files_uploaded + s_files_uploaded + i_files_uploaded + i_files_to_archive + g_files_uploaded + t_files_uploaded + d_files_uploaded + duplicate_files.keys(), share_paths,
+        file_hashes or staged_hashes)
+    move_files(f_files_error + s_files_error + i_files_error + g_files_error + t_files_error + d_files_error, get_error_dir(config), share_paths)
+
+    if feature_files or sample_files or image_files or other_xls_files or dna_sequence_files or duplicate_files:
+        send_upload_notification(config)
+
+    process_thumbsdb_cruft_files(thumbsdb_cruft_files)
+
+    return taxonomy_changes, s_sample_numbers
+
+# stage_functions: dictionary in the form {stage_name: function(db_conn, results)}
+# dependencies: dictionary in the form {stage_name: [names of stages it must wait for]}
+#
+# Runs each stage in its own thread, with a DB connection from the pool, as soon as
+# the stages it depends on have finished. Each stage function is passed the
+# results of the stages finished so far. If a stage fails no more stages are
+# started, and the error is raised once the running stages have finished.
+# Returns a tuple of ({stage_name: result}, {stage_name: elapsed seconds})
+def run_stages(stage_functions, dependencies):
+    start_time = time.time()
+    results = {}
+    elapsed = {}
+    failed_stages = []
+    finished_queue = Queue.Queue()
+
+    def run_stage(stage_name):
+        stage_start_time = time.time()
+        stage_db_conn = None
+        try:
+            stage_db_conn = borrow_db_connection(db_pool)
+            results[stage_name] = stage_functions[stage_name](stage_db_conn, results)
+        except Exception as e:
+            log.error('Error in ' + stage_name + ' stage')
+            log.exception(e)
+            failed_stages.append(stage_name)
+        finally:
+            if stage_db_conn is not None:
+                return_db_connection(db_pool, stage_db_conn)
+            elapsed[stage_name] = time.time() - stage_start_time
+            finished_queue.put(stage_name)
+
+    waiting = set(stage_functions.keys())
+    running = set()
+    while len(running) > 0 or (len(waiting) > 0 and len(failed_stages) == 0):
+        if len(failed_stages) == 0:
+            for stage_name in sorted(waiting):
+                if all([d in results for d in dependencies.get(stage_name, [])]):
+                    waiting.remove(stage_name)
+                    running.add(stage_name)
+                    thread = threading.Thread(target=run_stage, args=(stage_name,))
+                    thread.daemon = True
+                    thread.start()
+        if len(running) == 0:
+            raise Exception('Stages ' + ', '.join(sorted(waiting)) + ' depend on stages that will never run')
+        running.remove(finished_queue.get())
+
+    if len(failed_stages) > 0:
+        raise Exception('Error in ' + ', '.join(sorted(failed_stages)) + ' stage, '
+            + ('not run: ' + ', '.join(sorted(waiting)) if len(waiting) > 0 else 'all other stages completed'))
+
+    log.info('Stages completed in ' + format_elapsed(start_time) + ': '
+        + ', '.join(['%s %.1fs' % (stage_name, elapsed[stage_name]) for stage_name in sorted(elapsed)]))
+    return results, elapsed
+
+# args: command line arguments, e.g ['upload_data.py', 'cache', 'fill', '--resume']
+#
+# Returns the cache update requested on the command line, in the form
+#     {
+#        'cache_only': True if only the website data is to be updated, without looking for new files,
+#        'reload': True if the caches are to be flushed and reloaded,
+#        'fill': True if every cache entry is to be loaded,
+#        'resume': True to carry on from where an interrupted update stopped
+#     }
+def get_cache_command(args):
+    cache_only = len(args) > 1 and args[1].lower() == 'cache'
+    cache_args = [a.lower() for a in args[(2 if cache_only else 1):]]
+    if cache_only and (len(cache_args) == 0 or cache_args[0] not in ['fill', 'reload']):
+        raise Exception('Usage: upload_data.py cache fill|reload [--resume]')
+
+    return {
+        'cache_only': cache_only,
+        'reload': len(cache_args) > 0 and cache_args[0] == 'reload',
+        'fill': len(cache_args) > 0 and cache_args[0] == 'fill',
+        'resume': '--resume' in cache_args[1:]
+    }
+
+# taxonomy_changes: dictionary in the form returned by new_taxonomy_changes()
+# sample_numbers: set of sample numbers uploaded
+# cache_command: dictionary in the form returned by get_cache_command()
+#
+# Updates the taxonomy summary tables, published JSON and website caches
+# affected by the uploaded data, or all of them if requested.
+def update_website_data(config, db_conn, taxonomy_changes, sample_numbers, cache_command, s3_bucket=None):
+    summary_tables = get_taxonomy_load_options(config)['summary_tables']
+    if summary_tables:
+        update_taxonomy_summary_tables(db_conn, taxonomy_changes, cache_command['reload'])
+
+    cache_scope = get_cache_scope(db_conn, taxonomy_changes, sample_numbers, cache_command['reload'])
+    fill_caches = cache_command['fill']
+
+    json_export_options = get_json_export_options(config)
+    if json_export_options['enabled'] and summary_tables and (fill_caches or not is_cache_scope_empty(cache_scope)):
+        export_taxonomy_json(config, db_conn, json_export_options, s3_bucket)
+
+    # Update taxonomy caches if necessary
+    if fill_caches or not is_cache_scope_empty(cache_scope):
+        host = config.get('Website', 'host')
+        cache_summary = refresh_taxonomy_caches(host, db_conn, cache_scope, fill_caches, get_cache_warming_options(config),
+            cache_command['resume'], fill_caches or cache_command['reload'])
+        msg = 'Cache update complete on '+host + '\n' + cache_summary
+        send_email(
+            msg,
+            "1000 Springs cache update complete",
+            'cache_refreshed_to_csv',
+            config
+            )
 
 # keys used for attributes contained in image file names
 IMAGE_SAMPLE_NUMBER = 'sample_number'
 IMAGE_TYPE = 'image_type'
 
-# Recursively looks for files in the given directory, looking for files
-# with names that match expected image and data file name formats.
-def find_files(new_files_dir):
-
-    feature_file_re = re.compile('data-features-[0-9]+\.xls')
-    sample_file_re = re.compile('data-samples-[0-9]+\.xls')
-    other_xls_file_re = re.compile('.*\.xls')
-    thumbsdb_cruft_file_re = re.compile('Thumbs\.db')
-    image_file_re = re.compile('(P1\.\d{4})_([A-Z]*)_\d+\.jpg', re.IGNORECASE)
-    dna_sequence_file_re = re.compile('^.*\.fasta$')
+FEATURE_FILE_RE = re.compile('data-features-[0-9]+\.xls')
+SAMPLE_FILE_RE = re.compile('data-samples-[0-9]+\.xls')
+OTHER_XLS_FILE_RE = re.compile('.*\.xls')
+THUMBSDB_CRUFT_FILE_RE = re.compile('Thumbs\.db')
+IMAGE_FILE_RE = re.compile('(P1\.\d{4})_([A-Z]*)_\d+\.jpg', re.IGNORECASE)
+DNA_SEQUENCE_FILE_RE = re.compile('^.*\.fasta(?:\.gz|\.bz2)?$')
+
+# Returns the type of file with the given name, one of 'feature', 'sample',
+# 'xls', 'dna_sequence', 'thumbsdb' or 'image', or None if it isn't a type
+# that's uploaded
+def classify_file(filename):
+    if (FEATURE_FILE_RE.match(filename)):
+        return 'feature'
+    elif (SAMPLE_FILE_RE.match(filename)):
+        return 'sample'
+    elif (OTHER_XLS_FILE_RE.match(filename)):
+        return 'xls'
+    elif (DNA_SEQUENCE_FILE_RE.match(filename)):
+        return 'dna_sequence'
+    elif (THUMBSDB_CRUFT_FILE_RE.match(filename)):
+        return 'thumbsdb'
+    elif (IMAGE_FILE_RE.match(filename)):
+        return 'image'
+    return None
+
+# Sorts the given files into lists of files with names that match expected
+# image and data file name formats. Returns a tuple of (feature files, sample
+# files, {image file: image data}, other xls files, Thumbs.db files, DNA sequence files)
+def classify_files(file_paths):
     feature_files = []
     sample_files = []
     other_xls_files = []
     thumbsdb_cruft_files = []
     image_files = {}
     dna_sequence_files = []
-    for dirpath, dirnames, filenames in os.walk(new_files_dir):
-        for filename in filenames:
-            file_path = os.path.join(dirpath,filename)
-            if (feature_file_re.match(filename)):
-                feature_files.append(file_path)
+    for file_path in file_paths:
+        filename = os.path.basename(file_path)
+        file_type = classify_file(filename)
+        if file_type == 'feature':
+            feature_files.append(file_path)
 
-            elif (sample_file_re.match(filename)):
-                sample_files.append(file_path)
+        elif file_type == 'sample':
+            sample_files.append(file_path)
 
-            elif (other_xls_file_re.match(filename)):
-                other_xls_files.append(file_path)
+        elif file_type == 'xls':
+            other_xls_files.append(file_path)
 
-            elif (dna_sequence_file_re.match(filename)):
-                dna_sequence_files.append(file_path)
+        elif file_type == 'dna_sequence':
+            dna_sequence_files.append(file_path)
 
-            elif (thumbsdb_cruft_file_re.match(filename)):
-                thumbsdb_cruft_files.append(file_path)
+        elif file_type == 'thumbsdb':
+            thumbsdb_cruft_files.append(file_path)
 
-            else:
-                image = image_file_re.match(filename)
-                if (image):
-                    image_files[file_path] = {
-                        IMAGE_SAMPLE_NUMBER: image.group(1),
-                        IMAGE_TYPE: image.group(2)
-                    }
+        elif file_type == 'image':
+            image = IMAGE_FILE_RE.match(filename)
+            image_files[file_path] = {
+                IMAGE_SAMPLE_NUMBER: image.group(1),
+                IMAGE_TYPE: image.group(2)
+            }
 
     return feature_files, sample_files, image_files, other_xls_files, thumbsdb_cruft_files, dna_sequence_files
 
+# Returns the sample number in the given image file's name, e.g 'P1.0023'
+def get_image_sample_number(file_path):
+    return IMAGE_FILE_RE.match(os.path.basename(file_path)).group(1)
+
+#-------------------------------------------------------------------------------
+# INBOX MANIFEST
+#-------------------------------------------------------------------------------
+# Files which can't be uploaded yet (e.g images of samples which aren't in the
+# database) are left in the new files directory. To avoid examining them again
+# on every run, a manifest of the files found by the previous run is kept, in
+# the form
+#     {file_path: {'size': size, 'mtime': mtime, 'file_type': classify_file() value, 'outcome': outcome}}
+# where outcome is 'skipped' for files left in place after processing, or
+# 'ignored' for files that aren't a type that's uploaded. Unchanged files in the
+# manifest are only processed again if they're images of samples that have
+# since been uploaded.
+
+def get_inbox_manifest_file(config):
+    return get_config_option(config, MOUNT_SECTION, 'inbox_manifest',
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), 'inbox_manifest.txt'))
+
+def load_inbox_manifest(manifest_file):
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            for line in f:
+                file_path, size, mtime, file_type, outcome = line.rstrip('\n').split('\t')
+                manifest[file_path] = {'size': int(size), 'mtime': float(mtime), 'file_type': file_type or None, 'outcome': outcome}
+    return manifest
+
+def save_inbox_manifest(manifest_file, manifest):
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_file, 'w') as f:
+        for file_path, entry in sorted(manifest.iteritems()):
+            f.write('\t'.join([file_path, str(entry['size']), repr(entry['mtime']), entry['file_type'] or '', entry['outcome']]) + '\n')
+
+# Yields a (path, size, mtime) tuple for each file in the given directory and
+# its subdirectories
+def scan_files(dir_path):
+    if scandir is None:
+        log.info('scandir not available, looking up each file found')
+        for file_path in get_all_files(dir_path):
+            stat = os.stat(file_path)
+            yield file_path, stat.st_size, stat.st_mtime
+        return
+
+    for entry in scandir(dir_path):
+        if entry.is_dir():
+            for file_data in scan_files(entry.path):
+                yield file_data
+        elif entry.is_file():
+            stat = entry.stat()
+            yield entry.path, stat.st_size, stat.st_mtime
+
+# manifest: dictionary as described above, which is updated with the files found
+#
+# Returns a list of the files in new_files_dir which are new or have changed since
+# the manifest was written, plus skipped images whose sample is now in the database.
+def scan_new_files(db_conn, new_files_dir, manifest):
+    start_time = time.time()
+    scanned_manifest = {}
+    file_paths = []
+    skipped_images = {}
+    for file_path, size, mtime in scan_files(new_files_dir):
+        entry = manifest.get(file_path)
+        if entry is not None and entry['size'] == size and entry['mtime'] == mtime:
+            scanned_manifest[file_path] = entry
+            if entry['file_type'] == 'image' and entry['outcome'] == 'skipped':
+                skipped_images.setdefault(get_image_sample_number(file_path), []).append(file_path)
+        else:
+            scanned_manifest[file_path] = {'size': size, 'mtime': mtime, 'file_type': classify_file(os.path.basename(file_path)), 'outcome': None}
+            file_paths.append(file_path)
+    new_file_count = len(file_paths)
+
+    if len(skipped_images) > 0:
+        uploaded_samples = get_uploaded_sample_numbers(db_conn, skipped_images.keys())
+        for sample_number, image_paths in skipped_images.iteritems():
+            if sample_number.upper() in uploaded_samples:
+                file_paths.extend(image_paths)
+
+    manifest.clear()
+    manifest.update(scanned_manifest)
+    log.info('Scanned ' + str(len(manifest)) + ' files in ' + format_elapsed(start_time) + ': ' + str(new_file_count)
+        + ' new or changed, ' + str(len(file_paths) - new_file_count) + ' skipped images with newly uploaded samples')
+    return file_paths
+
+# Returns the set of the given sample numbers which are in the database, in
+# upper case. Image names are matched case insensitively, so they're compared
+# in upper case.
+def get_uploaded_sample_numbers(db_conn, sample_numbers):
+    cursor = db_conn.cursor()
+    try:
+        return set([n.upper() for n in get_sample_ids(cursor, sample_numbers)])
+    finally:
+        cursor.close()
+
+# file_paths: files processed, as returned by scan_new_files()
+#
+# Records the outcome of the files left in place after processing
+def update_inbox_manifest(manifest, file_paths):
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            entry = manifest[file_path]
+            entry['outcome'] = 'skipped' if entry['file_type'] is not None else 'ignored'
+        else:
+            # uploaded and moved to the archive or error directory
+            manifest.pop(file_path, None)
+
+
+#-------------------------------------------------------------------------------
+# UPLOAD LEDGER
+#-------------------------------------------------------------------------------
+# The upload_ledger table records the SHA-1 hash of each file uploaded. Files
+# dropped again with exactly the same content (e.g copied back from the
+# archive) are archived without being processed or written to the database,
+# as long as that content is still the latest uploaded under its file name.
+# So dropping an older version of a file again (to roll back a later upload)
+# still uploads it.
+
+UPLOAD_LEDGER_DDL = (
+    'create table if not exists upload_ledger ('
+    ' content_hash char(40) not null,'
+    ' file_type varchar(16) not null,'
+    ' file_name varchar(255) not null,'
+    ' row_count int null,'
+    ' uploaded_at datetime not null,'
+    ' primary key (content_hash),'
+    ' key (file_name))')
+
+def use_upload_ledger(config):
+    return get_config_option(config, MOUNT_SECTION, 'skip_uploaded_files', 'true').lower() == 'true'
+
+# known_hashes: dictionary in the form {file_path: SHA-1 hash} of files already
+#               hashed (e.g while staging them), or None
+#
+# Returns a dictionary in the form {file_path: SHA-1 hash of the file's content}
+def get_file_hashes(file_paths, known_hashes=None):
+    start_time = time.time()
+    file_hashes = {}
+    hashed_count = 0
+    for file_path in file_paths:
+        if known_hashes is not None and file_path in known_hashes:
+            file_hashes[file_path] = known_hashes[file_path]
+        else:
+            file_hashes[file_path] = get_file_hash(file_path)
+            hashed_count += 1
+    log.debug('Hashed ' + str(hashed_count) + ' of ' + str(len(file_hashes)) + ' files in ' + format_elapsed(start_time))
+    return file_hashes
+
+def get_file_hash(file_path):
+    content_hash = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), ''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+# file_hashes: dictionary in the form returned by get_file_hashes()
+#
+# Returns the files which have already been uploaded, and not been replaced by
+# a later upload of a file with the same name and type, in the form
+#     {file_path: {'file_name': name it was uploaded as, 'uploaded_at': datetime}}
+def find_uploaded_files(db_conn, file_hashes, batch_size=1000):
+    uploaded = {}
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(UPLOAD_LEDGER_DDL)
+        hashes = list(set(file_hashes.values()))
+        for batch_start in xrange(0, len(hashes), batch_size):
+            batch = hashes[batch_start:batch_start + batch_size]
+            cursor.execute('select l.content_hash, l.file_name, l.uploaded_at from upload_ledger l'
+                ' where l.content_hash in (' + ','.join(['%s'] * len(batch)) + ')'
+                ' and not exists (select 1 from upload_ledger later where later.file_name=l.file_name'
+                ' and later.file_type=l.file_type and later.uploaded_at>l.uploaded_at)', batch)
+            for content_hash, file_name, uploaded_at in cursor.fetchall():
+                uploaded[content_hash] = {'file_name': file_name, 'uploaded_at': uploaded_at}
+    finally:
+        cursor.close()
+
+    return dict([(f, uploaded[h]) for f, h in file_hashes.iteritems() if h in uploaded])
+
+# uploaded_files: list of (file_type, list of files uploaded) tuples, where
+#     each file is either a path or a [path, record count] list
+#
+# Adds the files uploaded to the ledger
+def record_uploaded_files(db_conn, file_hashes, uploaded_files):
+    rows = []
+    for file_type, files in uploaded_files:
+        for file_data in files:
+            if isinstance(file_data, basestring):
+                file_path, row_count = file_data, None
+            else:
+                file_path, row_count = file_data[0], file_data[1]
+            if file_path in file_hashes:
+                rows.append((file_hashes[file_path], file_type, get_relative_path(file_path)[-255:], row_count))
+
+    if len(rows) > 0:
+        with db_conn:
+            cursor = db_conn.cursor()
+            sql_params = []
+            for row in rows:
+                sql_params.extend(row)
+            cursor.execute(
+                'insert into upload_ledger (content_hash, file_type, file_name, row_count, uploaded_at) values '
+                + ','.join(['(%s,%s,%s,%s,now())'] * len(rows))
+                + ' on duplicate key update file_type=values(file_type), file_name=values(file_name),'
+                + ' row_count=values(row_count), uploaded_at=values(uploaded_at)',
+                sql_params)
+            cursor.close()
+
+#-------------------------------------------------------------------------------
+# UPLOAD LEASES
+#-------------------------------------------------------------------------------
+# When more than one uploader works on the same new files directory, each
+# claims the files it's going to process by taking out leases in the
+# upload_lease table. Spreadsheets and DNA sequence files are leased one file
+# at a time, and images by ranges of sample numbers (so all images of a sample
+# are uploaded together). Leases are renewed by a heartbeat while the files are
+# processed. If an uploader dies its leases expire, and the files can then be
+# claimed by another uploader.
+
+LEASE_SECTION = 'Lease'
+
+UPLOAD_LEASE_DDL = (
+    'create table if not exists upload_lease ('
+    ' lease_key varchar(255) not null,'
+    ' worker_id varchar(100) not null,'
+    ' expires_at datetime not null,'
+    ' heartbeat_at datetime not null,'
+    ' primary key (lease_key))')
+
+# file types which must be leased before they're processed
+LEASED_FILE_TYPES = ['feature', 'sample', 'xls', 'dna_sequence', 'image']
+
+def get_lease_options(config):
+    return {
+        'enabled': get_config_option(config, LEASE_SECTION, 'enabled', 'false').lower() == 'true',
+        'ttl': int(get_config_option(config, LEASE_SECTION, 'ttl_seconds', '300')),
+        'image_sample_range': int(get_config_option(config, LEASE_SECTION, 'image_sample_range', '100'))
+    }
+
+# Returns the lease key for the given file, e.g 'file:Lab/R1R2_Production.fasta'
+# or 'images:P1.0100-0199'
+def get_lease_key(file_path, file_type, image_sample_range):
+    if file_type == 'image':
+        sample_number = int(get_image_sample_number(file_path)[3:])
+        range_start = sample_number - sample_number % image_sample_range
+        return 'images:P1.%04d-%04d' % (range_start, range_start + image_sample_range - 1)
+
+    # the share may be mounted at different paths on each uploader's host
+    relative_path = get_relative_path(file_path).replace('\\', '/')
+    if len(relative_path) > 240:
+        relative_path = hashlib.sha1(relative_path.encode('utf-8') if isinstance(relative_path, unicode) else relative_path).hexdigest()
+    return 'file:' + relative_path
+
+# Claims leases on the given files, where they aren't already held by another
+# uploader, and starts a heartbeat to renew the leases.
+# Returns the leases in the form
+#     {
+#        'files': list of files claimed, plus any files which don't need a lease,
+#        'claimed': set of files claimed,
+#        'keys': list of lease keys held,
+#        'worker_id': e.g 'uploadhost:1234',
+#        'stop': event set to stop the heartbeat
+#     }
+def claim_upload_leases(config, file_paths):
+    lease_options = get_lease_options(config)
+    if not lease_options['enabled']:
+        return {'files': file_paths, 'claimed': set(file_paths), 'keys': [], 'worker_id': None, 'stop': None}
+
+    worker_id = socket.gethostname()[:90] + ':' + str(os.getpid())
+    file_keys = {}
+    unleased_files = []
+    for file_path in file_paths:
+        file_type = classify_file(os.path.basename(file_path))
+        if file_type in LEASED_FILE_TYPES:
+            file_keys[file_path] = get_lease_key(file_path, file_type, lease_options['image_sample_range'])
+        else:
+            unleased_files.append(file_path)
+
+    lease_keys = sorted(set(file_keys.values()))
+    held_keys = set()
+    if len(lease_keys) > 0:
+        db_conn = borrow_db_connection(db_pool)
+        try:
+            with db_conn:
+                cursor = db_conn.cursor()
+                cursor.execute(UPLOAD_LEASE_DDL)
+                # Each assignment sees the ones before it, so once worker_id is
+                # set (for a new or expired lease) the lease is renewed too
+                sql_params = []
+                for lease_key in lease_keys:
+                    sql_params.extend([lease_key, worker_id, lease_options['ttl']])
+                cursor.execute(
+                    'insert into upload_lease (lease_key, worker_id, expires_at, heartbeat_at) values '
+                    + ','.join(['(%s, %s, now() + interval %s second, now())'] * len(lease_keys))
+                    + ' on duplicate key update'
+                    + ' worker_id=if(expires_at < now(), values(worker_id), worker_id),'
+                    + ' heartbeat_at=if(worker_id=values(worker_id), values(heartbeat_at), heartbeat_at),'
+                    + ' expires_at=if(worker_id=values(worker_id), values(expires_at), expires_at)',
+                    sql_params)
+                cursor.execute('select lease_key from upload_lease where worker_id=%s', [worker_id])
+                held_keys = set([row[0] for row in cursor.fetchall()])
+                cursor.close()
+        finally:
+            return_db_connection(db_pool, db_conn)
+
+    # Leases are released once the files are moved, so a file another uploader
+    # has finished with since it was found can be claimed again. Drop those.
+    claimed = set([f for f, k in file_keys.iteritems() if k in held_keys and os.path.isfile(f)])
+    upload_leases = {
+        'files': [f for f in file_paths if f in claimed] + unleased_files,
+        'claimed': claimed,
+        'keys': sorted(held_keys),
+        'worker_id': worker_id,
+        'stop': threading.Event()
+    }
+    log.info('Claimed ' + str(len(held_keys)) + ' of ' + str(len(lease_keys)) + ' upload leases ('
+        + str(len(claimed)) + ' of ' + str(len(file_keys)) + ' files) as ' + worker_id)
+
+    if len(held_keys) > 0:
+        heartbeat = threading.Thread(target=renew_upload_leases, args=(upload_leases, lease_options['ttl']))
+        heartbeat.daemon = True
+        heartbeat.start()
+    return upload_leases
+
+# Renews the given leases every third of their time to live, until stopped
+def renew_upload_leases(upload_leases, ttl):
+    while not upload_leases['stop'].wait(ttl / 3.0):
+        try:
+            db_conn = borrow_db_connection(db_pool)
+            try:
+                with db_conn:
+                    cursor = db_conn.cursor()
+                    cursor.execute('update upload_lease set expires_at=now() + interval %s second, heartbeat_at=now()'
+                        ' where worker_id=%s', [ttl, upload_leases['worker_id']])
+                    cursor.close()
+            finally:
+                return_db_connection(db_pool, db_conn)
+        except Exception as e:
+            log.warn('Unable to renew upload leases: ' + str(e))
+
+# Stops the heartbeat and gives up the given leases
+def release_upload_leases(upload_leases):
+    if upload_leases is None or upload_leases['stop'] is None:
+        return
+    upload_leases['stop'].set()
+    if len(upload_leases['keys']) > 0:
+        db_conn = borrow_db_connection(db_pool)
+        try:
+            with db_conn:
+                cursor = db_conn.cursor()
+                execute_in_batches(cursor, 'delete from upload_lease where lease_key=%s and worker_id=%s',
+                    [(k, upload_leases['worker_id']) for k in upload_leases['keys']], 1000)
+                cursor.close()
+        finally:
+            return_db_connection(db_pool, db_conn)
+
+#-------------------------------------------------------------------------------
+# LOCAL STAGING
+#-------------------------------------------------------------------------------
+# Reading files straight from the data share is slow, particularly for lots of
+# small files, and several stages read each file more than once. So new files
+# are first copied (in parallel) into a local staging directory, keeping their
+# path relative to the new files directory, and processed from there. Only the
+# final moves to the archive or error directory touch the share again.
+
+def get_staging_dir(config):
+    staging_dir = get_config_option(config, MOUNT_SECTION, 'staging_dir', '').strip()
+    return os.path.normpath(staging_dir) if staging_dir != '' else None
+
+# Copies the given files to the staging directory, checking each copy's size
+# and SHA-1 hash against the original. Files which can't be copied, and files
+# of types which aren't uploaded, are left to be processed from the share.
+# Returns a tuple of (list of files to process, dictionary in the form {local copy: file on the share},
+# dictionary in the form {local copy: SHA-1 hash of the data copied})
+def stage_files(config, file_paths):
+    if staging_dir is None:
+        return file_paths, {}, {}
+
+    start_time = time.time()
+    worker_count = max(1, int(get_config_option(config, MOUNT_SECTION, 'staging_workers', '8')))
+    file_queue = Queue.Queue()
+    for file_path in file_paths:
+        if classify_file(os.path.basename(file_path)) not in [None, 'thumbsdb']:
+            file_queue.put(file_path)
+    local_paths = {}
+    file_hashes = {}
+
+    def staging_worker():
+        while True:
+            try:
+                file_path = file_queue.get_nowait()
+            except Queue.Empty:
+                break
+            local_path = os.path.join(staging_dir, get_relative_path(file_path))
+            try:
+                file_hashes[local_path] = stage_file(file_path, local_path)
+                local_paths[file_path] = local_path
+            except Exception as e:
+                log.warn('Unable to stage ' + file_path + ', processing it from the share: ' + str(e))
+
+    staged_count = file_queue.qsize()
+    threads = []
+    for i in range(min(worker_count, staged_count)):
+        thread = threading.Thread(target=staging_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    byte_count = sum([os.path.getsize(p) for p in local_paths.itervalues()])
+    log.info('Staged ' + str(len(local_paths)) + ' of ' + str(staged_count) + ' files (%.1f MB) in ' % (byte_count / 1048576.0)
+        + format_elapsed(start_time))
+    return [local_paths.get(f, f) for f in file_paths], dict([(l, f) for f, l in local_paths.iteritems()]), file_hashes
+
+# Copies file_path to local_path, hashing the data as it's read, then checks
+# the copy has the same size and hash. The modification time is copied too,
+# as it's part of the FASTA index signature. Returns the SHA-1 hash of the
+# file, so later steps don't have to hash it again.
+def stage_file(file_path, local_path):
+    local_dir = os.path.dirname(local_path)
+    if not os.path.isdir(local_dir):
+        try:
+            os.makedirs(local_dir)
+        except OSError:
+            # created by another staging thread in the meantime
+            if not os.path.isdir(local_dir):
+                raise
+
+    source_hash = hashlib.sha1()
+    with open(file_path, 'rb') as source, open(local_path, 'wb') as target:
+        for block in iter(lambda: source.read(1048576), ''):
+            source_hash.update(block)
+            target.write(block)
+    shutil.copystat(file_path, local_path)
+
+    if os.path.getsize(local_path) != os.path.getsize(file_path):
+        raise Exception('size of copy differs from the original')
+    file_hash = source_hash.hexdigest()
+    if get_file_hash(local_path) != file_hash:
+        raise Exception('content of copy differs from the original')
+    return file_hash
+
+# Deletes the local copies made by stage_files()
+def remove_staged_files(share_paths):
+    for local_path in share_paths:
+        if os.path.isfile(local_path):
+            os.remove(local_path)
+
+#-------------------------------------------------------------------------------
+# ARCHIVE BUNDLES
+#-------------------------------------------------------------------------------
+# With [DataShare] archive_mode set to bundle, the files processed by each run
+# are written to a new compressed zip bundle, filed by day, instead of being
+# moved into the archive directory one by one, e.g.
+#   Archive/bundles/2026/2026-10-18_221909_uploader1.zip
+#   Archive/bundles/2026/2026-10-18_221909_uploader1.tsv
+# The .tsv file indexes the bundle's contents: one line per file with its
+# member name, original path (relative to the new files directory), size,
+# SHA-1 hash and the time it was archived. Bundles are never reopened, and are
+# written under a temporary name which is only renamed once complete, so a
+# failed write can't damage files archived earlier. Files which failed to
+# upload are still moved to the error directory as loose files, so they can
+# be fixed.
+
+ARCHIVE_BUNDLE_DIR = 'bundles'
+ARCHIVE_INDEX_COLUMNS = ['member', 'path', 'size', 'sha1', 'archived_at']
+ARCHIVE_BUNDLE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})_.*\.zip$')
+ARCHIVE_TEMP_FILE_TYPE = '.tmp'
+
+# File types which are already compressed, so are stored in bundles as they are
+STORED_FILE_TYPES = ['.jpg', '.jpeg', '.gz', '.bz2', '.zip']
+
+def get_archive_mode(config):
+    archive_mode = get_config_option(config, MOUNT_SECTION, 'archive_mode', 'files').strip().lower()
+    if archive_mode not in ['files', 'bundle']:
+        raise Exception("Invalid archive_mode '" + archive_mode + "', expected files or bundle")
+    return archive_mode
+
+# Moves processed files to the archive directory, or writes them to a new
+# bundle, depending on the configured archive_mode
+def archive_files(config, file_list, share_paths=None, file_hashes=None):
+    if get_archive_mode(config) == 'bundle':
+        bundle_files(file_list, get_archive_dir(config), share_paths, file_hashes)
+    else:
+        move_files(file_list, get_archive_dir(config), share_paths)
+
+# Returns the paths of a new zip bundle and its index for the given time. The
+# names start with the date and time, so they sort in the order written.
+def get_archive_bundle_file(archive_dir, bundle_time):
+    bundle_dir = os.path.join(archive_dir, ARCHIVE_BUNDLE_DIR, str(bundle_time.year))
+    base_name = bundle_time.strftime('%Y-%m-%d_%H%M%S') + '_' + re.sub(r'[^\w.-]', '_', socket.gethostname())
+    bundle_name = base_name
+    i = 2
+    while (os.path.exists(os.path.join(bundle_dir, bundle_name + '.zip'))
+            or os.path.exists(os.path.join(bundle_dir, bundle_name + '.zip' + ARCHIVE_TEMP_FILE_TYPE))):
+        bundle_name = base_name + '_' + str(i)
+        i += 1
+    return os.path.join(bundle_dir, bundle_name + '.zip'), os.path.join(bundle_dir, bundle_name + '.tsv')
+
+# Writes the given files (file paths, or lists starting with the file path)
+# to a new bundle, then deletes them from the share. The bundle and its index
+# are complete before anything is deleted, so if writing them fails the files
+# are left where they were. file_hashes is a dictionary in the form
+# {file_path: SHA-1 hash} of files already hashed, the others are hashed here.
+def bundle_files(file_list, archive_dir, share_paths=None, file_hashes=None):
+    if len(file_list) == 0:
+        return
+
+    bundle_file, index_file = get_archive_bundle_file(archive_dir, datetime.now())
+    bundle_dir = os.path.dirname(bundle_file)
+    if not os.path.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    temp_bundle_file = bundle_file + ARCHIVE_TEMP_FILE_TYPE
+    temp_index_file = index_file + ARCHIVE_TEMP_FILE_TYPE
+    index_rows = []
+    archived_files = []
+    try:
+        bundle = zipfile.ZipFile(temp_bundle_file, 'w', zipfile.ZIP_DEFLATED, True)
+        try:
+            member_names = set(bundle.namelist())
+            for file_data in file_list:
+                file_path = file_data if isinstance(file_data, basestring) else file_data[0]
+                share_file = share_paths.get(file_path, file_path) if share_paths is not None else file_path
+                relative_path = get_relative_path(share_file).replace(os.sep, '/')
+
+                member_name = relative_path
+                i = 1
+                while member_name in member_names:
+                    member_name = relative_path + ' (' + str(i) + ')'
+                    i += 1
+                member_names.add(member_name)
+
+                compress_type = zipfile.ZIP_DEFLATED
+                if os.path.splitext(file_path)[1].lower() in STORED_FILE_TYPES:
+                    compress_type = zipfile.ZIP_STORED
+                # the local copy, if there is one, is quicker to read than the share
+                bundle.write(file_path, member_name, compress_type)
+
+                file_hash = file_hashes.get(file_path) if file_hashes is not None else None
+                index_rows.append([member_name, relative_path, str(os.path.getsize(file_path)),
+                    file_hash or get_file_hash(file_path), datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
+                archived_files.append(share_file)
+        finally:
+            bundle.close()
+
+        with open(temp_index_file, 'wb') as f:
+            f.write('#' + '\t'.join(ARCHIVE_INDEX_COLUMNS) + '\n')
+            for row in index_rows:
+                f.write('\t'.join(row) + '\n')
+
+        # bundles are only listed once the zip is in place, so rename the index first
+        os.rename(temp_index_file, index_file)
+        os.rename(temp_bundle_file, bundle_file)
+    except Exception:
+        for temp_file in [temp_bundle_file, temp_index_file]:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+        if os.path.isfile(index_file) and not os.path.isfile(bundle_file):
+            os.remove(index_file)
+        raise
+
+    for share_file in archived_files:
+        os.remove(share_file)
+        remove_dir(share_file)
+    log.info('Archived ' + str(len(archived_files)) + ' files to ' + bundle_file)
+
+# Returns the entries (dictionaries keyed by ARCHIVE_INDEX_COLUMNS, with size
+# as an int) in the given bundle index, in the order the files were archived
+def read_archive_index(index_file):
+    entries = []
+    if not os.path.isfile(index_file):
+        return entries
+    with open(index_file, 'rb') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line == '' or line.startswith('#'):
+                continue
+            entry = dict(zip(ARCHIVE_INDEX_COLUMNS, line.split('\t')))
+            entry['size'] = int(entry['size'])
+            entries.append(entry)
+    return entries
+
+# Returns the paths of the bundles in the given archive directory, oldest first,
+# optionally only those from start_date to end_date (inclusive)
+def get_archive_bundles(archive_dir, start_date=None, end_date=None):
+    bundles = []
+    for file_path in get_all_files(os.path.join(archive_dir, ARCHIVE_BUNDLE_DIR)):
+        match = ARCHIVE_BUNDLE_RE.match(os.path.basename(file_path))
+        if match is None:
+            continue
+        bundle_date = datetime.strptime(match.group(1), '%Y-%m-%d').date()
+        if (start_date is None or bundle_date >= start_date) and (end_date is None or bundle_date <= end_date):
+            bundles.append((bundle_date, os.path.basename(file_path), file_path))
+    return [b[2] for b in sorted(bundles)]
+
+# Yields an (index entry, file object) tuple for each file in the given bundle,
+# in the order they were archived. Each file object streams the file's content
+# from the bundle and is only valid until the next file is yielded.
+def iter_archive_bundle(bundle_file):
+    bundle = zipfile.ZipFile(bundle_file, 'r')
+    try:
+        for entry in read_archive_index(os.path.splitext(bundle_file)[0] + '.tsv'):
+            member = bundle.open(entry['member'])
+            try:
+                yield entry, member
+            finally:
+                member.close()
+    finally:
+        bundle.close()
+
+# Yields an (index entry, file object) tuple for each file archived from
+# start_date to end_date (inclusive), oldest first, e.g. to replay uploads:
+#   for entry, f in iter_archived_files(archive_dir, date(2026, 10, 1)):
+#       ...
+def iter_archived_files(archive_dir, start_date=None, end_date=None):
+    for bundle_file in get_archive_bundles(archive_dir, start_date, end_date):
+        for entry, member in iter_archive_bundle(bundle_file):
+            entry['bundle'] = bundle_file
+            yield entry, member
+
+# Extracts the given archived file (an index entry from iter_archived_files()
+# or read_archive_index(), with a 'bundle' key) to target_dir, keeping its path
+# relative to the new files directory, and checks its SHA-1 hash against the
+# index. Returns the path of the extracted file.
+def extract_archived_file(entry, target_dir):
+    target_file = os.path.join(target_dir, *entry['path'].split('/'))
+    target_folder = os.path.dirname(target_file)
+    if not os.path.isdir(target_folder):
+        os.makedirs(target_folder)
+
+    bundle = zipfile.ZipFile(entry['bundle'], 'r')
+    try:
+        file_hash = hashlib.sha1()
+        member = bundle.open(entry['member'])
+        try:
+            with open(target_file, 'wb') as f:
+                for block in iter(lambda: member.read(1048576), ''):
+                    file_hash.update(block)
+                    f.write(block)
+        finally:
+            member.close()
+    finally:
+        bundle.close()
+
+    if file_hash.hexdigest() != entry['sha1']:
+        raise Exception('Content of ' + entry['member'] + ' in ' + entry['bundle'] + ' differs from its index')
+    return target_file
 
 #-------------------------------------------------------------------------------
 # FEATURE FILE PROCESSING
@@ -290,10 +1213,12 @@ def process_sample_files(db_conn, files_to_process):
 
     files_uploaded = []
     files_error = []
+    sample_numbers = set()
     for sample_file in sorted(files_to_process):
         try:
             log.info('Processing sample file ' + sample_file)
             row_count = 0
+            file_sample_numbers = set()
             with db_conn:
                 cursor = db_conn.cursor()
                 rows = get_tablet_data_rows(sample_file)
@@ -305,16 +1230,18 @@ def process_sample_files(db_conn, files_to_process):
                     cursor.execute(sql, sql_params)
                     sql, sql_params = get_sample_insert_sql(db_conn, row, sample)
                     cursor.execute(sql, sql_params)
+                    file_sample_numbers.add(row['SampleNumber'])
                     row_count += 1
 
             files_uploaded.append([sample_file, row_count])
+            sample_numbers.update(file_sample_numbers)
 
         except Exception as e:
             log.error('Error processing sample file ' + sample_file)
             log.exception(e)
             files_error.append(sample_file)
 
-    return files_uploaded, files_error
+    return files_uploaded, files_error, sample_numbers
 
 
 # data-sample spreadsheet column -> DB sample table column
@@ -460,16 +1387,13 @@ def set_boolean_column(row, column_name, comment_true_re, comment_false_re):
 #-------------------------------------------------------------------------------
 # IMAGE FILE PROCESSING
 #-------------------------------------------------------------------------------
-def process_image_files(config, db_conn, files_to_process):
+def process_image_files(config, db_conn, files_to_process, s3_bucket=None):
 
     image_config = 'ImageProcessing'
     working_dir = config.get(image_config, 'working_dir')
     watermark_file = config.get(image_config, 'watermark_file')
-    s3_conn = S3Connection(
-        config.get(image_config, 'aws_access_key_id'),
-        config.get(image_config, 'aws_secret_access_key')
-        )
-    s3_bucket = s3_conn.get_bucket(config.get('ImageProcessing', 's3_bucket_name'))
+    if s3_bucket is None:
+        s3_bucket = get_s3_bucket(config)
     s3_bucket_url = config.get(image_config, 's3_bucket_url')
     s3_folder = config.get(image_config, 's3_folder')
 
@@ -527,6 +1451,7 @@ def get_sample_id(db_conn, sample_number):
 # watermark_file: path to file to use to watermark the reduced image, or None
 #                 if no watermark is to be applied
 def reduce_image(raw_image_file, new_image_file, max_width, height, watermark_file):
+    from PIL import Image
     image = Image.open(raw_image_file)
     exif_data = image._getexif()
 
@@ -565,6 +1490,7 @@ def reduce_image(raw_image_file, new_image_file, max_width, height, watermark_fi
 # returns False.
 def upload_image(db_conn, image_file, image_data, sample_id,
                  s3_bucket, s3_folder, s3_bucket_url):
+    from boto.s3.key import Key
 
     key = None
     image_uploaded = False
@@ -642,6 +1568,7 @@ def get_image_id(db_conn, sample_id, image_type):
 # GEOCHEMISTRY FILE PROCESSING
 #-------------------------------------------------------------------------------
 def process_geochem_files(db_conn, files_to_process):
+    xlrd = get_xlrd()
     files_uploaded = []
     files_error = []
     files_skipped = []
@@ -749,7 +1676,7 @@ BELOW_DETECTION_LIMIT_RE = re.compile('^\s*<\s*([0-9]+|(?:[0-9]*\.[0-9]+))$')
 
 # Returns true if the given worksheet appears to contain data in the GNS NZGAL format
 def is_nzgal_geochem(worksheet):
-    return worksheet.cell_type(0, 0) == xlrd.XL_CELL_TEXT and worksheet.cell_value(0,0) == 'Geochemistry Results'
+    return worksheet.cell_type(0, 0) == get_xlrd().XL_CELL_TEXT and worksheet.cell_value(0,0) == 'Geochemistry Results'
 
 
 # Returns true if the given worksheet appears to contain data in the Waikato University format
@@ -782,23 +1709,37 @@ def is_uow_geochem(worksheet):
 # Returns the number of records inserted or updated.
 def process_nzgal_geochem_worksheet(db_conn, worksheet, file_name, workbook):
 
-    param_column = 0
     geochem_updates = []
+    for sample_number, row_data in read_nzgal_geochem_worksheet(worksheet, file_name, workbook):
+        add_geochem_update_data(geochem_updates, sample_number, row_data, db_conn)
+
+    row_count = perform_geochem_updates(db_conn, geochem_updates)
+
+    return row_count
+
+
+# problems: list to add (cell name, problem) tuples to instead of raising an
+#           exception at the first bad result, or None
+#
+# Parses the given NZGAL format worksheet. Returns a list of
+# (sample number, row_data) tuples, one per result column.
+def read_nzgal_geochem_worksheet(worksheet, file_name, workbook, problems=None):
+
+    param_column = 0
+    geochem_rows = []
     use_formatting = False
     for col_index in range (2, worksheet.ncols):
         sample_number = None
         row_data = {}
         for row_index in range (0, worksheet.nrows):
             parameter_name = worksheet.cell_value(row_index, param_column)
-            add_geochem_result(row_data, sample_number, parameter_name, worksheet, row_index, col_index, file_name, workbook, use_formatting)
+            add_geochem_result(row_data, sample_number, parameter_name, worksheet, row_index, col_index, file_name, workbook, use_formatting, problems)
             new_sample_number = get_geochem_sample_number(worksheet, row_index, col_index)
             sample_number = new_sample_number if (new_sample_number!= None) else sample_number
 
-        add_geochem_update_data(geochem_updates, sample_number, row_data, db_conn)
+        geochem_rows.append((sample_number, row_data))
 
-    row_count = perform_geochem_updates(db_conn, geochem_updates)
-
-    return row_count
+    return geochem_rows
 
 
 # worksheet: xlrd worksheet instance created from an Excel workbook
@@ -808,29 +1749,46 @@ def process_nzgal_geochem_worksheet(db_conn, worksheet, file_name, workbook):
 # Returns the number of records inserted or updated.
 def process_uow_geochem_worksheet(db_conn, worksheet, file_name, workbook):
 
+    geochem_updates = []
+    for sample_number, row_data in read_uow_geochem_worksheet(worksheet, file_name, workbook):
+        add_geochem_update_data(geochem_updates, sample_number, row_data, db_conn)
+
+    row_count = perform_geochem_updates(db_conn, geochem_updates)
+
+    return row_count
+
+
+# problems: list to add (cell name, problem) tuples to instead of raising an
+#           exception at the first bad result, or None
+#
+# Parses the given Waikato University format worksheet. Returns a list of
+# (sample number, row_data) tuples, one per result row.
+def read_uow_geochem_worksheet(worksheet, file_name, workbook, problems=None):
+
     param_row = 0
     sample_num_col = 0
-    geochem_updates = []
+    geochem_rows = []
     use_formatting = True
     for row_index in range (1, worksheet.nrows):
         sample_number = get_geochem_sample_number(worksheet, row_index, sample_num_col)
         row_data = {}
         for col_index in range (1, worksheet.ncols):
             parameter_name = worksheet.cell_value(param_row, col_index)
-            add_geochem_result(row_data, sample_number, parameter_name, worksheet, row_index, col_index, file_name, workbook, use_formatting)
+            add_geochem_result(row_data, sample_number, parameter_name, worksheet, row_index, col_index, file_name, workbook, use_formatting, problems)
 
-        add_geochem_update_data(geochem_updates, sample_number, row_data, db_conn)
+        geochem_rows.append((sample_number, row_data))
 
-    row_count = perform_geochem_updates(db_conn, geochem_updates)
-
-    return row_count
+    return geochem_rows
 
 
 # row_data: dictionary in the form {parameter_name: result}, e.g: {NH4: 3.69, PO4: 0.343}
+# problems: list to add (cell name, problem) tuples to instead of raising an
+#           exception, or None. Results which aren't numbers (and so are
+#           uploaded as blanks) are added too.
 #
 # Reads a result from the given worksheet at the specified [row, column] and
 # adds it to the given row_data.
-def add_geochem_result(row_data, sample_number, parameter_name, worksheet, result_row, result_col, file_name, workbook, use_formatting):
+def add_geochem_result(row_data, sample_number, parameter_name, worksheet, result_row, result_col, file_name, workbook, use_formatting, problems=None):
     if (sample_number != None and parameter_name in GEOCHEMISTRY_COLUMN_MAP):
         # result values should be '[numeric value]' or '<[numeric value]
         # if the concentration is less than the detection limit.
@@ -839,15 +1797,25 @@ def add_geochem_result(row_data, sample_number, parameter_name, worksheet, resul
         # Values less than 0 are treated as 0
 
         #result = str(worksheet.cell_value(result_row, result_col))
-        result = read_value(worksheet, workbook, result_row, result_col, use_formatting)
-        interpreted_result = interpret_geochem_result(result)
-        if result is None:
-            raise Exception(
-                'Unexpected '+parameter_name+' result value "'+result+'" for sample '
-                + sample_number + ' in ' + file_name
-                + ' cell ['+str(result_row)+','+str(result_col)+']')
-        else:
-            row_data[parameter_name] = interpreted_result
+        try:
+            result = read_value(worksheet, workbook, result_row, result_col, use_formatting)
+            interpreted_result = interpret_geochem_result(result)
+            if result is None:
+                raise Exception(
+                    'Unexpected '+parameter_name+' result value "'+result+'" for sample '
+                    + sample_number + ' in ' + file_name
+                    + ' cell ['+str(result_row)+','+str(result_col)+']')
+        except Exception as e:
+            if problems is None:
+                raise
+            problems.append((get_cell_name(result_row, result_col), parameter_name + ' result for sample '
+                + sample_number + ' could not be read: ' + str(e)))
+            return
+
+        if problems is not None and interpreted_result is None and unicode(result).strip() != '':
+            problems.append((get_cell_name(result_row, result_col), 'Unexpected ' + parameter_name + ' result value "'
+                + unicode(result) + '" for sample ' + sample_number + ', it would be uploaded as a blank'))
+        row_data[parameter_name] = interpreted_result
 
 
 # Matches '0.00', '0.000', etc
@@ -901,7 +1869,7 @@ def interpret_geochem_result(result):
 # is found.
 def get_geochem_sample_number(worksheet, row_index, col_index):
     sample_number = None
-    if worksheet.cell_type(row_index, col_index) == xlrd.XL_CELL_TEXT:
+    if worksheet.cell_type(row_index, col_index) == get_xlrd().XL_CELL_TEXT:
         sample_match = SAMPLE_NUMBER_RE.match(worksheet.cell_value(row_index, col_index))
         if (sample_match):
             sample_number = 'P1.' + sample_match.group(1)
@@ -987,10 +1955,28 @@ def get_geochem_update_sql(geochem_id, row):
 #-------------------------------------------------------------------------------
 # TAXONOMY FILE PROCESSING
 #-------------------------------------------------------------------------------
-def process_taxonomy_files(db_conn, files_to_process):
+# dna_sequence_files: FASTA files uploaded in the same run. Where one matches a
+#     taxonomy file its sequences are written along with the taxonomy records.
+#     Each taxonomy load replaces the records of the loads before it, so only
+#     the FASTA file written with the last one counts as attached. Any others
+#     are left for the DNA sequence update to apply to the records kept.
+#
+# Returns a tuple containing:
+#  - list of [file name, record count] for taxonomy files uploaded
+#  - list of files not uploaded due to errors
+#  - list of files skipped as they aren't taxonomy files
+#  - dictionary of the data changed, in the form returned by new_taxonomy_changes()
+#  - list of [file name, matched OTU count, unmatched OTU count] for the DNA
+#    sequence file written along with the last taxonomy file loaded, if any
+def process_taxonomy_files(config, db_conn, files_to_process, dna_sequence_files):
+    xlrd = get_xlrd()
     files_uploaded = []
     files_error = []
     files_skipped = []
+    sequences_attached = []
+    load_options = get_taxonomy_load_options(config)
+    index_options = get_fasta_index_options(config)
+    taxonomy_changes = new_taxonomy_changes()
     for xls_file in files_to_process:
         # open excel spreadsheet - this loads the file into memory then closes it
         try:
@@ -1001,7 +1987,12 @@ def process_taxonomy_files(db_conn, files_to_process):
             row_count = 0
             if is_taxonomy(worksheet):
                 log.info('Processing taxonomy data file ' + xls_file)
-                row_count = process_taxonomy_worksheet(db_conn, worksheet, get_relative_path(xls_file), workbook)
+                dna_sequence_file = get_paired_dna_sequence_file(xls_file, dna_sequence_files)
+                file_sequences_attached = []
+                row_count = process_taxonomy_worksheet(db_conn, worksheet, get_relative_path(xls_file), workbook,
+                    load_options, taxonomy_changes, dna_sequence_file, index_options, file_sequences_attached)
+                # the records written with earlier taxonomy files have just been replaced
+                sequences_attached = file_sequences_attached
 
             if row_count == 0:
                 files_skipped.append(xls_file)
@@ -1014,7 +2005,103 @@ def process_taxonomy_files(db_conn, files_to_process):
             log.exception(e)
             files_error.append(xls_file)
 
-    return files_uploaded, files_error, files_skipped
+    return files_uploaded, files_error, files_skipped, taxonomy_changes, sequences_attached
+
+# Looks for a FASTA file holding the DNA sequences for the given taxonomy file.
+# As with DNA sequence updates, the taxonomy file name must start with the
+# FASTA file name, e.g 'R1R2_Production_OTUtable.xls' and 'R1R2_Production.fasta'.
+# Returns the most specific matching FASTA file, or None if no file matches.
+def get_paired_dna_sequence_file(xls_file, dna_sequence_files):
+    data_file_name = remove_file_type(xls_file)
+    paired_files = [f for f in dna_sequence_files if data_file_name.startswith(remove_file_type(f))]
+    if len(paired_files) == 0:
+        return None
+
+    # Use the most specific match
+    return max(paired_files, key=lambda f: len(remove_file_type(f)))
+
+# taxonomy_updates: taxonomy data in the form returned by new_taxonomy_updates()
+#
+# Streams the records of the given FASTA file into the matching taxonomy rows,
+# so the sequences are written along with the rest of each row. OTU ids are
+# matched case insensitively, as with DNA sequence updates, and only the
+# sequences of OTUs in the taxonomy data are kept. Returns a tuple of
+# (matched OTU count, unmatched OTU count), or None if the file can't be read,
+# in which case the taxonomy rows are left without sequences.
+def attach_dna_sequences(taxonomy_updates, dna_sequence_file, index_options):
+    taxonomy_by_otu_id = {}
+    for taxonomy_data in taxonomy_updates['taxonomy_data']:
+        taxonomy_data['sequence'] = None
+        taxonomy_by_otu_id.setdefault(taxonomy_data['otu_id'].upper(), []).append(taxonomy_data)
+
+    matched_otu_ids = set()
+    unmatched_otu_ids = set()
+    try:
+        otu_ids = set(taxonomy_by_otu_id)
+        for otu_id, dna_sequence in read_dna_sequence_file(dna_sequence_file, index_options, otu_ids):
+            otu_id = otu_id.upper()
+            matching_taxonomy = taxonomy_by_otu_id.get(otu_id)
+            if matching_taxonomy is None:
+                unmatched_otu_ids.add(otu_id)
+                continue
+            for taxonomy_data in matching_taxonomy:
+                taxonomy_data['sequence'] = dna_sequence
+            matched_otu_ids.add(otu_id)
+    except Exception as e:
+        # Leave the file to be reported by the DNA sequence file processing
+        log.warn('Unable to read DNA sequence file ' + dna_sequence_file + ' with its taxonomy file: ' + str(e))
+        for taxonomy_data in taxonomy_updates['taxonomy_data']:
+            taxonomy_data.pop('sequence', None)
+        return None
+
+    return len(matched_otu_ids), len(unmatched_otu_ids)
+
+TAXONOMY_SECTION = 'Taxonomy'
+
+# Taxonomy table load modes:
+#   replace: delete and re-insert all rows in a single transaction
+#   bulk: load into staging tables then swap them in with an atomic rename
+#   diff: compare with the rows already in the database and only write the differences
+TAXONOMY_LOAD_MODES = ['replace', 'bulk', 'diff']
+
+# Returns a dictionary of taxonomy loading settings read from the config, e.g
+#     {'load_mode': 'bulk', 'bulk_insert_rows': 1000, 'bulk_load_writers': 4, 'summary_tables': True}
+# The config is included so bulk loads can open extra database connections.
+def get_taxonomy_load_options(config):
+    load_mode = get_config_option(config, TAXONOMY_SECTION, 'load_mode', 'replace').lower()
+    if load_mode not in TAXONOMY_LOAD_MODES:
+        raise Exception('Unknown taxonomy load_mode "' + load_mode + '", expected one of ' + ', '.join(TAXONOMY_LOAD_MODES))
+
+    return {
+        'load_mode': load_mode,
+        'bulk_insert_rows': int(get_config_option(config, TAXONOMY_SECTION, 'bulk_insert_rows', '1000')),
+        'bulk_load_writers': max(1, int(get_config_option(config, TAXONOMY_SECTION, 'bulk_load_writers', '1'))),
+        'summary_tables': get_config_option(config, TAXONOMY_SECTION, 'summary_tables', 'true').lower() == 'true'
+    }
+
+# Returns an empty record of the data changed by taxonomy file uploads, in the form
+#     {
+#        'full_reload': True if all taxonomy data was rewritten, so everything
+#                       should be treated as changed,
+#        'sample_numbers': set of sample numbers whose taxonomy links, or the
+#                          OTUs they link to, changed,
+#        'domains': set of domains of the OTUs that changed,
+#        'phyla': set of phyla of the OTUs that changed
+#     }
+def new_taxonomy_changes():
+    return {
+        'full_reload': False,
+        'sample_numbers': set(),
+        'domains': set(),
+        'phyla': set()
+    }
+
+# Adds the domain and phylum of the given taxonomy record to taxonomy_changes
+def add_changed_taxon(taxonomy_changes, taxonomy_data):
+    if taxonomy_data.get('domain') is not None:
+        taxonomy_changes['domains'].add(taxonomy_data['domain'])
+    if taxonomy_data.get('phylum') is not None:
+        taxonomy_changes['phyla'].add(taxonomy_data['phylum'])
 
 # Returns true if the given worksheet appears to contain data in the taxonomy/DNA format
 def is_taxonomy(worksheet):
@@ -1031,48 +2118,111 @@ TAXONOMY_SAMPLE_NUMBER_RE = re.compile('^\s*P1.(\d{4}).*$', re.IGNORECASE)
 
 # worksheet: xlrd worksheet instance created from an Excel workbook
 # file_name: absolute path of the Excel workbook
+# dna_sequence_file: FASTA file holding the sequences to write along with the
+#     taxonomy records, or None
+# sequences_attached: list to add [FASTA file, matched OTU count, unmatched OTU count]
+#     to once the taxonomy records have been written with their sequences
 #
 # Parses the given taxonomy worksheet, and inserts relevant results into the database.
 # Returns the number of records inserted or updated.
-def process_taxonomy_worksheet(db_conn, worksheet, file_name, workbook):
+def process_taxonomy_worksheet(db_conn, worksheet, file_name, workbook, load_options, taxonomy_changes,
+        dna_sequence_file=None, index_options=None, sequences_attached=None):
+
+    taxonomy_updates = read_taxonomy_worksheet(worksheet, file_name)
+    sequence_counts = None
+    if dna_sequence_file is not None:
+        log.info('Reading DNA sequences for ' + file_name + ' from ' + dna_sequence_file)
+        sequence_counts = attach_dna_sequences(taxonomy_updates, dna_sequence_file, index_options)
+
+    # Perform database inserts
+    log.info('Finished extracting data from ' + file_name)
+    record_taxonomy_load(db_conn, remove_file_type(file_name))
+    if load_options['load_mode'] == 'diff':
+        row_count = perform_taxonomy_diff_updates(db_conn, taxonomy_updates, load_options['bulk_insert_rows'], taxonomy_changes)
+    elif load_options['load_mode'] == 'bulk':
+        row_count = perform_taxonomy_bulk_load(db_conn, taxonomy_updates, load_options)
+        taxonomy_changes['full_reload'] = True
+    else:
+        row_count = perform_taxonomy_updates(db_conn, taxonomy_updates)
+        taxonomy_changes['full_reload'] = True
+
+    if sequence_counts is not None and row_count > 0 and sequences_attached is not None:
+        sequences_attached.append([dna_sequence_file] + list(sequence_counts))
+
+    return row_count
+
+# problems: list to add (cell name, problem) tuples to, or None. Where given,
+#           rows with cells that can't be read are added to it and skipped
+#           rather than raising an exception.
+#
+# Parses the given taxonomy worksheet. Returns the data in the form returned
+# by new_taxonomy_updates().
+def read_taxonomy_worksheet(worksheet, file_name, problems=None):
 
-    taxonomy_updates = []
     taxonomy_columns, sample_columns = get_taxonomy_columns(worksheet)
-    # Parse worksheet contents to extract data
+    taxonomy_updates = new_taxonomy_updates(sorted(sample_columns, key=sample_columns.get))
+    sample_column_indexes = [sample_columns[s] for s in taxonomy_updates['sample_numbers']]
+    taxonomy_column_items = taxonomy_columns.items()
+    otu_id_column = taxonomy_columns['otu_id']
+    data_file_name = remove_file_type(file_name)
+
+    # Parse worksheet contents to extract data, a row at a time
     for row_index in range (1, worksheet.nrows):
-        otu_id = worksheet.cell_value(row_index, taxonomy_columns['otu_id'])
+        row = worksheet.row_values(row_index)
+        otu_id = row[otu_id_column]
+        if problems is not None and not check_taxonomy_row(row, row_index, otu_id_column,
+                taxonomy_column_items, sample_column_indexes, problems):
+            continue
         if OTU_ID_RE.match(otu_id):
             taxonomy_data = {
                 'otu_id': otu_id,
-                'data_file_name': remove_file_type(file_name)
+                'data_file_name': data_file_name
             }
-            for db_column_name, sheet_column_index in taxonomy_columns.iteritems():
-                    value = str(worksheet.cell_value(row_index, sheet_column_index))
+            for db_column_name, sheet_column_index in taxonomy_column_items:
+                    value = str(row[sheet_column_index])
                     if len(value) == 0:
                         value = None
                     elif db_column_name.endswith('_confidence'):
                         value = float(value)
                     taxonomy_data[db_column_name] = value
 
-            sample_taxonomy_data = []
-            for sample_number, sample_column_index in sample_columns.iteritems():
-                read_count = int(worksheet.cell_value(row_index, sample_column_index))
-                if read_count > 0:
-                    sample_taxonomy_data.append({
-                        'sample_number': sample_number,
-                        'read_count':read_count
-                    })
+            add_taxonomy_update(taxonomy_updates, taxonomy_data, [row[i] for i in sample_column_indexes])
 
-            taxonomy_updates.append({
-                'taxonomy_data': taxonomy_data,
-                'sample_taxonomy_data': sample_taxonomy_data
-                })
+    return taxonomy_updates
 
-    # Perform database inserts
-    log.info('Finished extracting data from ' + file_name)
-    row_count = perform_taxonomy_updates(db_conn, taxonomy_updates)
+# Checks the cells of the given taxonomy worksheet row can be read as they
+# are by read_taxonomy_worksheet(), adding a (cell name, problem) tuple to
+# problems for each one that can't. Returns True if the row can be read.
+def check_taxonomy_row(row, row_index, otu_id_column, taxonomy_column_items, sample_column_indexes, problems):
+    otu_id = row[otu_id_column]
+    if not isinstance(otu_id, basestring):
+        problems.append((get_cell_name(row_index, otu_id_column), 'OTU ID "' + unicode(otu_id) + '" is not text'))
+        return False
+    elif not OTU_ID_RE.match(otu_id):
+        return True
 
-    return row_count
+    row_ok = True
+    for db_column_name, sheet_column_index in taxonomy_column_items:
+        try:
+            value = str(row[sheet_column_index])
+            if len(value) > 0 and db_column_name.endswith('_confidence'):
+                float(value)
+        except (ValueError, UnicodeError):
+            problems.append((get_cell_name(row_index, sheet_column_index), 'Unexpected ' + db_column_name
+                + ' value "' + unicode(row[sheet_column_index]) + '" for ' + otu_id))
+            row_ok = False
+
+    for sheet_column_index in sample_column_indexes:
+        value = row[sheet_column_index]
+        try:
+            if value != 0:
+                int(value)
+        except (ValueError, TypeError):
+            problems.append((get_cell_name(row_index, sheet_column_index), 'Read count "' + unicode(value)
+                + '" for ' + otu_id + ' is not a number'))
+            row_ok = False
+
+    return row_ok
 
 # taxonomy spreadsheet column -> DB taxonomy table column
 TAXONOMY_COLUMN_MAP = {
@@ -1117,30 +2267,88 @@ def get_taxonomy_columns(worksheet, header_row_index = 0):
 
     return taxonomy_columns, sample_columns
 
-# taxonomy_updates: list of dictionaries in the form
+# sample_numbers: sample numbers of the worksheet's sample columns, in column order
+#
+# Returns an empty taxonomy_updates dictionary. The read counts are held in
+# compressed sparse row form, as most OTUs are only found in a few samples:
 #     {
-#        'taxonomy_data': {
-#            'otu_id': 'OTU_670',
-#            'data_file_name': 'R1R2_Production_OTUtable',
-#            'domain': 'Bacteria',
-#            'domain_confidence': 0.99,
-#            ...+ phylum, class, order etc.
-#         },
-#        'sample_taxonomy_data': [
+#        'taxonomy_data': [
 #            {
-#                'sample_number': 'P1.0001',
-#                'read_count': '23'
+#                'otu_id': 'OTU_670',
+#                'data_file_name': 'R1R2_Production_OTUtable',
+#                'domain': 'Bacteria',
+#                'domain_confidence': 0.99,
+#                ...+ phylum, class, order etc.
 #            },
-#            {
-#                'sample_number': 'P1.0021',
-#                'read_count': '517'
-#            }
-#        ]
+#            ...one per OTU
+#        ],
+#        'sample_numbers': ['P1.0001', 'P1.0021', ...],
+#        'otu_offsets': array('l', [0, 2, ...]),
+#        'sample_indexes': array('i', [0, 1, ...]),
+#        'read_counts': array('i', [23, 517, ...])
 #     }
+# The non-zero read counts of the OTU at taxonomy_data[i] are held at positions
+# otu_offsets[i] to otu_offsets[i+1] of read_counts, with the matching
+# sample_indexes giving the position of each sample in sample_numbers.
+def new_taxonomy_updates(sample_numbers):
+    return {
+        'taxonomy_data': [],
+        'sample_numbers': sample_numbers,
+        'otu_offsets': array('l', [0]),
+        'sample_indexes': array('i'),
+        'read_counts': array('i')
+    }
+
+# taxonomy_data: dictionary of taxonomy DB column values for a single OTU
+# sample_values: read count cell values for the OTU, in sample_numbers order
+#
+# Appends the OTU and its non-zero read counts to the given taxonomy_updates.
+def add_taxonomy_update(taxonomy_updates, taxonomy_data, sample_values):
+    sample_indexes = taxonomy_updates['sample_indexes']
+    read_counts = taxonomy_updates['read_counts']
+    for sample_index, value in enumerate(sample_values):
+        # Cells are floats, so only convert the (relatively few) non-zero ones
+        if value != 0:
+            read_count = int(value)
+            if read_count > 0:
+                sample_indexes.append(sample_index)
+                read_counts.append(read_count)
+
+    taxonomy_updates['taxonomy_data'].append(taxonomy_data)
+    taxonomy_updates['otu_offsets'].append(len(read_counts))
+
+# Returns a list of (sample_index, read_count) tuples for the OTU at position
+# otu_index of the given taxonomy_updates
+def get_otu_read_counts(taxonomy_updates, otu_index):
+    start = taxonomy_updates['otu_offsets'][otu_index]
+    end = taxonomy_updates['otu_offsets'][otu_index + 1]
+    return zip(taxonomy_updates['sample_indexes'][start:end], taxonomy_updates['read_counts'][start:end])
+
+# sample_numbers: sample numbers of the taxonomy worksheet's sample columns
+# placeholder_sample_numbers: list to add the sample numbers of any placeholder
+#                             records inserted to, or None
+#
+# Looks up all the given samples with a single query, inserting placeholder
+# sample records for any not yet in the database.
+# Returns a list of sample.id values, in the same order as sample_numbers.
+def get_taxonomy_sample_ids(db_conn, cursor, sample_numbers, placeholder_sample_numbers=None):
+    sample_ids = get_sample_ids(cursor, sample_numbers)
+    missing_sample_numbers = [s for s in sample_numbers if s not in sample_ids]
+    if len(missing_sample_numbers) > 0:
+        log.info('Adding placeholder records for ' + str(len(missing_sample_numbers)) + ' samples not in the database')
+        insert_dummy_samples(cursor, missing_sample_numbers)
+        if placeholder_sample_numbers is not None:
+            placeholder_sample_numbers.extend(missing_sample_numbers)
+        sample_ids.update(get_sample_ids(cursor, missing_sample_numbers))
+
+    return [sample_ids[s] for s in sample_numbers]
+
+# taxonomy_updates: dictionary in the form returned by new_taxonomy_updates()
 #
 # Adds the given taxonomy data into the database via inserts or updates.
 def perform_taxonomy_updates(db_conn, taxonomy_updates):
     row_count = 0
+    sample_numbers = taxonomy_updates['sample_numbers']
     with db_conn:
         cursor = db_conn.cursor()
         # Each update contains the full set of taxonomy data,
@@ -1149,35 +2357,24 @@ def perform_taxonomy_updates(db_conn, taxonomy_updates):
         # from website for extended period.
         cursor.execute('delete from sample_taxonomy')
         cursor.execute('delete from taxonomy')
-        sample_id_cache={}
-        for update_data in taxonomy_updates:
+        sample_ids = get_taxonomy_sample_ids(db_conn, cursor, sample_numbers)
+        for otu_index, taxonomy_data in enumerate(taxonomy_updates['taxonomy_data']):
             # insert or update taxonomy record
-            taxonomy_data =  update_data['taxonomy_data']
             sql, sql_params = get_insert_sql('taxonomy', taxonomy_data)
             cursor.execute(sql, sql_params)
             taxonomy_id = db_conn.insert_id()
 
             # insert sample_taxonomy records
-            if len(update_data['sample_taxonomy_data']) > 0:
+            otu_read_counts = get_otu_read_counts(taxonomy_updates, otu_index)
+            if len(otu_read_counts) > 0:
                 sql_params = []
-                for sample_taxonomy_data in update_data['sample_taxonomy_data']:
-                    sample_number = sample_taxonomy_data.pop('sample_number')
-                    if sample_number in sample_id_cache:
-                        sample_id = sample_id_cache[sample_number]
-                    else:
-                        sample = get_sample(db_conn, sample_number)
-                        if sample is None:
-                            sample_id = insert_dummy_sample(db_conn, cursor, sample_number)
-                        else:
-                            sample_id = sample['id']
-                        sample_id_cache[sample_number] = sample_id
-
-                    sql_params.extend([sample_id, taxonomy_id, sample_taxonomy_data['read_count']])
-
-
-                sql = 'insert into sample_taxonomy (sample_id,taxonomy_id,read_count) values (%s,%s,%s) ' + (', (%s,%s,%s)' * (len(update_data['sample_taxonomy_data']) - 1))
+                for sample_index, read_count in otu_read_counts:
+                    sql_params.extend([sample_ids[sample_index], taxonomy_id, read_count])
+
+
+                sql = 'insert into sample_taxonomy (sample_id,taxonomy_id,read_count) values (%s,%s,%s) ' + (', (%s,%s,%s)' * (len(otu_read_counts) - 1))
                 cursor.execute(sql, sql_params)
-                log.info('Linked ' + str(len(update_data['sample_taxonomy_data'])) + ' samples to taxonomy data ' +
+                log.info('Linked ' + str(len(otu_read_counts)) + ' samples to taxonomy data ' +
                     taxonomy_data['otu_id'] + ' from ' + taxonomy_data['data_file_name'])
             else:
                 log.warn('No samples found with read counts for '+ taxonomy_data['otu_id'])
@@ -1188,6 +2385,342 @@ def perform_taxonomy_updates(db_conn, taxonomy_updates):
     return row_count
 
 
+# taxonomy_updates: dictionary in the form returned by new_taxonomy_updates()
+# load_options: dictionary in the form returned by get_taxonomy_load_options()
+#
+# Loads the given taxonomy data into empty taxonomy_new and sample_taxonomy_new
+# staging tables, then swaps them in place of the live tables with a single
+# atomic rename. The website keeps reading the old tables until the swap, and
+# no long running transaction is held open while the data is loaded. If the
+# load fails before the swap, the staging tables and any placeholder samples
+# added for it are removed.
+def perform_taxonomy_bulk_load(db_conn, taxonomy_updates, load_options):
+    start_time = time.time()
+    batch_size = load_options['bulk_insert_rows']
+    taxonomy_data = taxonomy_updates['taxonomy_data']
+    sample_numbers = taxonomy_updates['sample_numbers']
+    staged_tables = ['taxonomy', 'sample_taxonomy']
+    placeholder_sample_numbers = []
+    cursor = db_conn.cursor()
+    try:
+        taxonomy_indexes = create_staging_table(cursor, 'taxonomy', staged_tables)
+        sample_taxonomy_indexes = create_staging_table(cursor, 'sample_taxonomy', staged_tables)
+
+        # Taxonomy ids are assigned here rather than by auto increment, so the
+        # sample links can be written without reading back each insert id.
+        # Ids carry on from the live table so they are not reused.
+        cursor.execute('select coalesce(max(id), 0) from taxonomy')
+        first_taxonomy_id = cursor.fetchone()[0] + 1
+
+        # The placeholders are committed so the parallel writers' connections can see them
+        sample_ids = get_taxonomy_sample_ids(db_conn, cursor, sample_numbers, placeholder_sample_numbers)
+        db_conn.commit()
+
+        if len(taxonomy_data) > 0:
+            column_names = taxonomy_data[0].keys()
+            sql = ('insert into `taxonomy_new` (`id`,`' + '`,`'.join(column_names) + '`) values ('
+                + ','.join(['%s'] * (len(column_names) + 1)) + ')')
+            for batch_start in xrange(0, len(taxonomy_data), batch_size):
+                batch = taxonomy_data[batch_start:batch_start + batch_size]
+                sql_params = [[first_taxonomy_id + batch_start + i] + [row[c] for c in column_names] for i, row in enumerate(batch)]
+                cursor.executemany(sql, sql_params)
+                db_conn.commit()
+
+        if load_options['bulk_load_writers'] > 1:
+            link_count = insert_sample_taxonomy_links_in_parallel('sample_taxonomy_new',
+                taxonomy_updates, sample_ids, first_taxonomy_id, batch_size, load_options['bulk_load_writers'])
+        else:
+            link_count = insert_sample_taxonomy_links(db_conn, cursor, 'sample_taxonomy_new',
+                taxonomy_updates, sample_ids, first_taxonomy_id, 0, len(taxonomy_data), batch_size)
+        log.info('Loaded ' + str(len(taxonomy_data)) + ' taxonomy records and ' + str(link_count)
+            + ' sample links into staging tables in ' + format_elapsed(start_time))
+
+        # Indexes and foreign keys are built once over the loaded data rather than maintained row by row
+        add_table_indexes(cursor, 'taxonomy_new', taxonomy_indexes)
+        add_table_indexes(cursor, 'sample_taxonomy_new', sample_taxonomy_indexes)
+        swap_staging_tables(cursor, staged_tables)
+
+    except Exception:
+        load_error = sys.exc_info()
+        try:
+            db_conn.rollback()
+            # the staging tables only still exist if they weren't swapped in
+            cursor.execute("show tables like 'taxonomy_new'")
+            swapped = cursor.fetchone() is None
+            cursor.execute('drop table if exists sample_taxonomy_new, taxonomy_new')
+            if not swapped and len(placeholder_sample_numbers) > 0:
+                with db_conn:
+                    cursor.execute('delete from sample where sample_number in ('
+                        + ','.join(['%s'] * len(placeholder_sample_numbers)) + ')', placeholder_sample_numbers)
+        except Exception as e:
+            log.error('Unable to clean up after failed bulk taxonomy load: ' + str(e))
+        raise load_error[0], load_error[1], load_error[2]
+
+    finally:
+        cursor.close()
+
+    log.info('Bulk taxonomy load complete in ' + format_elapsed(start_time))
+    return len(taxonomy_data)
+
+
+# taxonomy_updates: dictionary in the form returned by new_taxonomy_updates()
+# batch_size: number of rows to send in each multi-row statement
+# taxonomy_changes: dictionary in the form returned by new_taxonomy_changes(),
+#                   the samples and taxa touched by the update are added to it
+#
+# Brings the taxonomy tables into line with the given taxonomy data by applying
+# only the differences. Taxonomy rows are matched on (data_file_name, otu_id)
+# and sample_taxonomy rows on (sample, OTU). As with a full reload, taxonomy rows
+# which are not in the new data are removed. All changes are made in a single
+# transaction.
+def perform_taxonomy_diff_updates(db_conn, taxonomy_updates, batch_size, taxonomy_changes):
+    start_time = time.time()
+    taxonomy_data = taxonomy_updates['taxonomy_data']
+    sample_numbers = taxonomy_updates['sample_numbers']
+    inserted = []
+    changed = []
+    link_inserts = []
+    link_updates = []
+    link_deletes = []
+    changed_taxon_sample_ids = set()
+    with db_conn:
+        cursor = db_conn.cursor()
+
+        include_sequence = len(taxonomy_data) > 0 and 'sequence' in taxonomy_data[0]
+        existing_taxonomy, duplicate_taxonomy_ids = get_existing_taxonomy(cursor, include_sequence)
+        existing_links = get_existing_sample_taxonomy(cursor)
+
+        sample_ids = get_taxonomy_sample_ids(db_conn, cursor, sample_numbers)
+        sample_numbers_by_id = dict(zip(sample_ids, sample_numbers))
+
+        for otu_index, new_data in enumerate(taxonomy_data):
+            key = (new_data['data_file_name'], new_data['otu_id'])
+            old_data = existing_taxonomy.pop(key, None)
+            if old_data is None:
+                sql, sql_params = get_insert_sql('taxonomy', new_data)
+                cursor.execute(sql, sql_params)
+                taxonomy_id = db_conn.insert_id()
+                inserted.append(new_data)
+                add_changed_taxon(taxonomy_changes, new_data)
+            else:
+                taxonomy_id = old_data['id']
+                changed_values = dict([(c, v) for c, v in new_data.iteritems() if taxonomy_value_changed(old_data.get(c), v)])
+                if len(changed_values) > 0:
+                    sql, sql_params = get_update_sql('id', taxonomy_id, 'taxonomy', changed_values)
+                    cursor.execute(sql, sql_params)
+                    changed.append(new_data)
+                    changed_taxon_sample_ids.update(existing_links.get(taxonomy_id, {}))
+                    add_changed_taxon(taxonomy_changes, old_data)
+                    add_changed_taxon(taxonomy_changes, new_data)
+
+            old_links = existing_links.pop(taxonomy_id, {})
+            links_changed = False
+            for sample_index, read_count in get_otu_read_counts(taxonomy_updates, otu_index):
+                sample_id = sample_ids[sample_index]
+                old_read_count = old_links.pop(sample_id, None)
+                if old_read_count is None:
+                    link_inserts.append((sample_id, taxonomy_id, read_count))
+                elif old_read_count != read_count:
+                    link_updates.append((read_count, sample_id, taxonomy_id))
+                else:
+                    continue
+                taxonomy_changes['sample_numbers'].add(sample_numbers[sample_index])
+                links_changed = True
+
+            for sample_id in old_links:
+                link_deletes.append((sample_id, taxonomy_id))
+                links_changed = True
+            if links_changed:
+                add_changed_taxon(taxonomy_changes, new_data)
+
+        # Whatever is left over is no longer in the taxonomy data
+        removed = existing_taxonomy.values()
+        removed_ids = [t['id'] for t in removed] + duplicate_taxonomy_ids
+        for t in removed:
+            add_changed_taxon(taxonomy_changes, t)
+        removed_link_sample_ids = set([sample_id for taxonomy_id in removed_ids for sample_id in existing_links.get(taxonomy_id, {})])
+        removed_link_sample_ids.update([sample_id for sample_id, taxonomy_id in link_deletes])
+        removed_link_sample_ids.update(changed_taxon_sample_ids)
+
+        for batch_start in xrange(0, len(removed_ids), batch_size):
+            batch = removed_ids[batch_start:batch_start + batch_size]
+            id_params = ','.join(['%s'] * len(batch))
+            cursor.execute('delete from sample_taxonomy where taxonomy_id in (' + id_params + ')', batch)
+            cursor.execute('delete from taxonomy where id in (' + id_params + ')', batch)
+
+        execute_in_batches(cursor, 'delete from sample_taxonomy where sample_id=%s and taxonomy_id=%s', link_deletes, batch_size)
+        execute_in_batches(cursor, 'update sample_taxonomy set read_count=%s where sample_id=%s and taxonomy_id=%s', link_updates, batch_size)
+        execute_in_batches(cursor, 'insert into sample_taxonomy (sample_id,taxonomy_id,read_count) values (%s,%s,%s)', link_inserts, batch_size)
+
+        # Samples only found in removed links (or linked to changed OTUs) aren't in this taxonomy file, look them up
+        unknown_sample_ids = [i for i in removed_link_sample_ids if i not in sample_numbers_by_id]
+        taxonomy_changes['sample_numbers'].update([sample_numbers_by_id[i] for i in removed_link_sample_ids if i in sample_numbers_by_id])
+        taxonomy_changes['sample_numbers'].update(get_sample_numbers(cursor, unknown_sample_ids, batch_size))
+
+    log.info('Taxonomy diff applied in ' + format_elapsed(start_time) + ': OTUs '
+        + str(len(inserted)) + ' inserted, ' + str(len(changed)) + ' changed, ' + str(len(removed_ids)) + ' removed; sample links '
+        + str(len(link_inserts)) + ' inserted, ' + str(len(link_updates)) + ' changed, '
+        + str(len(link_deletes) + sum([len(existing_links.get(i, {})) for i in removed_ids])) + ' removed')
+
+    return len(taxonomy_data)
+
+
+# include_sequence: True if the DNA sequences are to be compared too, they are
+#     usually written by the DNA sequence upload rather than the taxonomy upload
+#
+# Returns a tuple containing:
+#  - a dictionary of all taxonomy rows, in the form {(data_file_name, otu_id): row_dict}
+#  - a list of ids of rows which duplicate the (data_file_name, otu_id) of another row
+def get_existing_taxonomy(cursor, include_sequence):
+    cursor.execute('select * from taxonomy')
+    columns = [i[0] for i in cursor.description]
+    existing_taxonomy = {}
+    duplicate_ids = []
+    for row in cursor.fetchall():
+        row_data = dict(zip(columns, row))
+        if not include_sequence:
+            row_data.pop('sequence', None)
+        key = (row_data['data_file_name'], row_data['otu_id'])
+        if key in existing_taxonomy:
+            duplicate_ids.append(row_data['id'])
+        else:
+            existing_taxonomy[key] = row_data
+
+    return existing_taxonomy, duplicate_ids
+
+# Returns all sample_taxonomy read counts, in the form {taxonomy_id: {sample_id: read_count}}
+def get_existing_sample_taxonomy(cursor):
+    cursor.execute('select taxonomy_id, sample_id, read_count from sample_taxonomy')
+    existing_links = {}
+    for taxonomy_id, sample_id, read_count in cursor.fetchall():
+        existing_links.setdefault(taxonomy_id, {})[sample_id] = read_count
+
+    return existing_links
+
+# Returns True if the new taxonomy column value differs from the value already
+# in the database. Confidence values are compared numerically.
+def taxonomy_value_changed(old_value, new_value):
+    if old_value is None or new_value is None:
+        return old_value is not new_value
+    if isinstance(new_value, float):
+        return abs(float(old_value) - new_value) > 1e-9
+    if isinstance(new_value, str):
+        new_value = new_value.decode('utf-8')
+    return old_value != new_value
+
+# Returns the sample numbers of the samples with the given sample.id values
+def get_sample_numbers(cursor, sample_ids, batch_size):
+    sample_numbers = []
+    for batch_start in xrange(0, len(sample_ids), batch_size):
+        batch = sample_ids[batch_start:batch_start + batch_size]
+        cursor.execute('select sample_number from sample where id in (' + ','.join(['%s'] * len(batch)) + ')', batch)
+        sample_numbers.extend([row[0] for row in cursor.fetchall()])
+
+    return sample_numbers
+
+
+# writer_count: number of partitions to split the links into
+#
+# Splits the sample_taxonomy links into OTU ranges holding roughly equal numbers
+# of links, then inserts each range concurrently on its own database connection.
+# Returns the total number of rows inserted.
+def insert_sample_taxonomy_links_in_parallel(table_name, taxonomy_updates, sample_ids,
+        first_taxonomy_id, batch_size, writer_count):
+
+    partitions = partition_otus(taxonomy_updates['otu_offsets'], writer_count)
+    results = [None] * len(partitions)
+
+    def write_partition(partition_index, otu_start, otu_end):
+        partition_start_time = time.time()
+        try:
+            conn = borrow_db_connection(db_pool)
+            try:
+                cursor = conn.cursor()
+                link_count = insert_sample_taxonomy_links(conn, cursor, table_name, taxonomy_updates,
+                    sample_ids, first_taxonomy_id, otu_start, otu_end, batch_size)
+                cursor.close()
+            finally:
+                return_db_connection(db_pool, conn)
+            elapsed = max(time.time() - partition_start_time, 0.001)
+            log.info('Partition %d (OTUs %d-%d): %d sample links in %.1fs (%d links/s)'
+                % (partition_index + 1, otu_start, otu_end - 1, link_count, elapsed, link_count / elapsed))
+            results[partition_index] = link_count
+
+        except Exception as e:
+            log.error('Error writing partition %d (OTUs %d-%d)' % (partition_index + 1, otu_start, otu_end - 1))
+            log.exception(e)
+            results[partition_index] = e
+
+    log.info('Writing sample links in ' + str(len(partitions)) + ' partitions')
+    threads = []
+    for partition_index, (otu_start, otu_end) in enumerate(partitions):
+        thread = threading.Thread(target=write_partition, args=(partition_index, otu_start, otu_end))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    failed = [i + 1 for i, result in enumerate(results) if not isinstance(result, (int, long))]
+    if len(failed) > 0:
+        raise Exception('Failed to write sample taxonomy partitions ' + ', '.join(map(str, failed)))
+
+    return sum(results)
+
+# otu_offsets: OTU read count offsets, as held in taxonomy_updates
+#
+# Returns a list of up to partition_count (otu_start, otu_end) ranges covering
+# all OTUs, chosen so each range holds about the same number of read counts.
+def partition_otus(otu_offsets, partition_count):
+    otu_count = len(otu_offsets) - 1
+    link_count = otu_offsets[-1]
+    partitions = []
+    otu_start = 0
+    for partition in range(1, partition_count + 1):
+        otu_end = otu_start
+        target = link_count * partition / partition_count
+        while otu_end < otu_count and (otu_offsets[otu_end] < target or otu_end == otu_start):
+            otu_end += 1
+        if partition == partition_count:
+            otu_end = otu_count
+        if otu_end > otu_start:
+            partitions.append((otu_start, otu_end))
+        otu_start = otu_end
+
+    return partitions
+
+# table_name: name of the staging table's target table, e.g 'sample_taxonomy'
+# first_taxonomy_id: taxonomy.id assigned to the OTU at taxonomy_data[0]
+# otu_start, otu_end: range of OTU positions whose links are to be inserted
+#
+# Inserts sample_taxonomy rows for the given range of OTUs using multi-row inserts.
+# Returns the number of rows inserted.
+def insert_sample_taxonomy_links(db_conn, cursor, table_name, taxonomy_updates, sample_ids,
+        first_taxonomy_id, otu_start, otu_end, batch_size):
+    otu_offsets = taxonomy_updates['otu_offsets']
+    sample_indexes = taxonomy_updates['sample_indexes']
+    read_counts = taxonomy_updates['read_counts']
+    sql = 'insert into `' + table_name + '` (sample_id,taxonomy_id,read_count) values (%s,%s,%s)'
+    sql_params = []
+    link_count = 0
+    for otu_index in xrange(otu_start, otu_end):
+        taxonomy_id = first_taxonomy_id + otu_index
+        for i in xrange(otu_offsets[otu_index], otu_offsets[otu_index + 1]):
+            sql_params.append((sample_ids[sample_indexes[i]], taxonomy_id, read_counts[i]))
+
+        if len(sql_params) >= batch_size:
+            cursor.executemany(sql, sql_params)
+            db_conn.commit()
+            link_count += len(sql_params)
+            sql_params = []
+
+    if len(sql_params) > 0:
+        cursor.executemany(sql, sql_params)
+        db_conn.commit()
+        link_count += len(sql_params)
+
+    return link_count
+
+
 #-------------------------------------------------------------------------------
 # DNA SEQUENCE FILE PROCESSING
 #-------------------------------------------------------------------------------
@@ -1195,79 +2728,1067 @@ def perform_taxonomy_updates(db_conn, taxonomy_updates):
 # Matches '>OTU_670', '>OTU_25', etc
 OTU_ID_LINE_RE = re.compile('^>(OTU_\d+)$', re.IGNORECASE)
 
-def process_dna_sequence_files(db_conn, files_to_process):
+# Number of sequences sent in each multi-row insert
+DNA_SEQUENCE_BATCH_SIZE = 500
+
+# Returns a tuple containing:
+#  - list of [file name, number of OTUs matched to taxonomy records] for files uploaded
+#  - list of files not uploaded due to errors
+#  - list of [file name, matched OTU count, unmatched OTU count] for files uploaded
+def process_dna_sequence_files(config, db_conn, files_to_process):
     files_uploaded = []
     files_error = []
+    otu_match_counts = []
+    index_options = get_fasta_index_options(config)
     for dna_sequence_file in files_to_process:
         try:
-            record_count = perform_dna_sequence_updates(db_conn, dna_sequence_file)
-            files_uploaded.append([dna_sequence_file, record_count])
+            matched_count, unmatched_count = perform_dna_sequence_updates(db_conn, dna_sequence_file, index_options)
+            files_uploaded.append([dna_sequence_file, matched_count])
+            otu_match_counts.append([dna_sequence_file, matched_count, unmatched_count])
         except Exception as e:
             log.error('Error processing DNA sequence file ' + dna_sequence_file)
             log.exception(e)
             files_error.append(dna_sequence_file)
 
-    return files_uploaded, files_error
+    return files_uploaded, files_error, otu_match_counts
 
-def perform_dna_sequence_updates(db_conn, dna_sequence_file):
+# Loads the sequences in the given FASTA file into a temporary table, then
+# copies them to the matching taxonomy records with a single joined update.
+# Returns a tuple of (number of OTUs matched to taxonomy records,
+# number of OTUs with no matching taxonomy record).
+def perform_dna_sequence_updates(db_conn, dna_sequence_file, index_options):
 
     file_name = remove_file_type(dna_sequence_file)
-    record_count = 0
+    record_taxonomy_load(db_conn, file_name)
 
     with db_conn:
         cursor = db_conn.cursor()
-        otu_id = None
-        dna_sequence = None
-        with open(dna_sequence_file) as f:
+        # Taxonomy data file names start with the DNA sequence file name, resolve
+        # them once up front so the update can match them exactly
+        data_file_names = get_taxonomy_data_file_names(cursor, file_name)
+        # Indexed files only need the sequences of the OTUs to be updated read
+        otu_ids = None
+        if use_fasta_index(dna_sequence_file, index_options):
+            otu_ids = get_taxonomy_otu_ids(cursor, data_file_names)
+        cursor.execute('drop temporary table if exists dna_sequence_update')
+        cursor.execute(
+            'create temporary table dna_sequence_update ('
+            ' otu_id varchar(50) not null primary key,'
+            ' sequence longtext'
+            ') default charset=utf8')
+        try:
             log.info('Processing DNA sequence data file ' + dna_sequence_file)
-            for line in f:
-                otu_id_line = OTU_ID_LINE_RE.match(line)
-                if otu_id_line:
-                    if otu_id is not None:
-                        update_dna_sequence(cursor, file_name, otu_id, dna_sequence)
-                        record_count += 1
+            load_dna_sequences(cursor, read_dna_sequence_file(dna_sequence_file, index_options, otu_ids))
 
-                    otu_id = otu_id_line.group(1)
-                    dna_sequence = ''
-                else:
-                    dna_sequence += line.strip()
+            matched_count, unmatched_count = apply_dna_sequence_updates(cursor, data_file_names)
 
-        update_dna_sequence(cursor, file_name, otu_id, dna_sequence)
-        record_count += 1
+        finally:
+            cursor.execute('drop temporary table if exists dna_sequence_update')
 
-    return record_count
+    log.info(dna_sequence_file + ': ' + str(matched_count) + ' OTUs matched taxonomy records in '
+        + (', '.join(data_file_names) if data_file_names else 'no data files') + ', ' + str(unmatched_count) + ' unmatched')
 
+    return matched_count, unmatched_count
+
+
+# dna_sequence_records: iterable of (otu_id, dna_sequence) tuples, the sequence
+#     may be None for OTUs which won't be matched
+#
+# Inserts the given sequences into the dna_sequence_update temporary table using
+# multi-row inserts. If an OTU appears more than once the last sequence is kept.
+def load_dna_sequences(cursor, dna_sequence_records):
+    sql = 'insert into dna_sequence_update (otu_id, sequence) values (%s, %s) on duplicate key update sequence=values(sequence)'
+    sql_params = []
+    for record in dna_sequence_records:
+        sql_params.append(record)
+        if len(sql_params) >= DNA_SEQUENCE_BATCH_SIZE:
+            cursor.executemany(sql, sql_params)
+            sql_params = []
+
+    if len(sql_params) > 0:
+        cursor.executemany(sql, sql_params)
+
+
+# data_file_names: taxonomy.data_file_name values of the records to be updated
+#
+# Copies the sequences loaded in the dna_sequence_update temporary table into
+# the matching taxonomy records. Returns a tuple of (matched OTU count, unmatched OTU count).
+def apply_dna_sequence_updates(cursor, data_file_names):
+    cursor.execute('select count(*) from dna_sequence_update')
+    otu_count = cursor.fetchone()[0]
+    if len(data_file_names) == 0:
+        return 0, otu_count
+
+    data_file_params = ','.join(['%s'] * len(data_file_names))
+    cursor.execute(
+        'select count(*) from dna_sequence_update s where exists'
+        ' (select 1 from taxonomy t where t.otu_id=s.otu_id and t.data_file_name in (' + data_file_params + '))',
+        data_file_names)
+    matched_count = cursor.fetchone()[0]
+
+    cursor.execute(
+        'update taxonomy t join dna_sequence_update s on s.otu_id=t.otu_id'
+        ' set t.sequence=s.sequence where t.data_file_name in (' + data_file_params + ')',
+        data_file_names)
+
+    return matched_count, otu_count - matched_count
+
+
+# file_name: DNA sequence file name without file type, e.g 'R1R2_Production'
+# Returns the distinct taxonomy.data_file_name values starting with the given file name
+def get_taxonomy_data_file_names(cursor, file_name):
+    # Escape LIKE wildcards, as file names often contain underscores
+    prefix = file_name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    cursor.execute('select distinct data_file_name from taxonomy where data_file_name like %s', [prefix + '%'])
+    return [row[0] for row in cursor.fetchall()]
+
+# Returns the set of (upper case) OTU ids of the taxonomy records with the given data file names
+def get_taxonomy_otu_ids(cursor, data_file_names):
+    if len(data_file_names) == 0:
+        return set()
+    cursor.execute('select distinct otu_id from taxonomy where data_file_name in (' + ','.join(['%s'] * len(data_file_names)) + ')',
+        data_file_names)
+    return set([row[0].upper() for row in cursor.fetchall()])
+
+
+# otu_ids: set of upper case OTU ids of the sequences wanted, or None for all
+#
+# Generator returning an (otu_id, dna_sequence) tuple for each record in the
+# given FASTA file. Large uncompressed files are read via a (persisted) index
+# built in parallel, other files are streamed. When read via an index, only
+# the sequences of the given OTUs are read, the others are returned as None.
+def read_dna_sequence_file(dna_sequence_file, index_options, otu_ids=None):
+    if use_fasta_index(dna_sequence_file, index_options):
+        fasta_index = get_fasta_index(dna_sequence_file, index_options)
+        for record in read_indexed_fasta_records(dna_sequence_file, fasta_index, otu_ids):
+            yield record
+    else:
+        with open_data_file(dna_sequence_file) as f:
+            for record in read_fasta_records(f, dna_sequence_file):
+                yield record
+
+
+# f: open FASTA file
+# file_name: name of the file, just used for error reporting
+#
+# Generator returning an (otu_id, dna_sequence) tuple for each record in the
+# given FASTA file. Each sequence's lines are collected in a list and joined
+# once the whole record has been read. Raises an exception if a header line
+# isn't in the expected '>OTU_123' form.
+def read_fasta_records(f, file_name):
+    otu_id = None
+    sequence_lines = []
+    line_number = 0
+    for line in f:
+        line_number += 1
+        line = line.strip()
+        if line.startswith('>'):
+            otu_id_line = OTU_ID_LINE_RE.match(line)
+            if not otu_id_line:
+                raise Exception('Unexpected FASTA header "' + line + '" in ' + file_name + ' line ' + str(line_number))
+
+            if otu_id is not None:
+                yield otu_id, ''.join(sequence_lines)
+
+            otu_id = otu_id_line.group(1)
+            sequence_lines = []
+
+        elif len(line) > 0:
+            if otu_id is None:
+                raise Exception('DNA sequence found before first FASTA header in ' + file_name + ' line ' + str(line_number))
+            sequence_lines.append(line)
+
+    if otu_id is not None:
+        yield otu_id, ''.join(sequence_lines)
 
-def update_dna_sequence(cursor, file_name, otu_id, dna_sequence):
-    sql = 'update taxonomy set sequence=%s where data_file_name like %s and otu_id=%s'
-    cursor.execute(sql, [dna_sequence, file_name + '%', otu_id])
 
 #-------------------------------------------------------------------------------
-# CACHE OPERATIONS
+# FASTA INDEXING
+#
+# Very large FASTA files are indexed by splitting them into record aligned
+# chunks, each memory mapped on its own (so 32-bit Python never has to map the
+# whole file) and scanned in parallel worker processes. The index is saved to
+# disk (in a tab delimited form similar to a samtools .fai file) so later runs
+# against the same file can skip the scan. Sequences are then read from the
+# file by OTU id, and only those which match taxonomy records are read.
 #-------------------------------------------------------------------------------
-def init_caches(host, db_conn):
-    init_taxonomy_overview_cache(host, db_conn)
-    init_taxonomy_summary_cache(host, db_conn)
+DNA_SEQUENCE_SECTION = 'DnaSequence'
+
+# Largest chunk a FASTA file is split into for indexing, as each is memory mapped whole
+FASTA_MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+# Returns a dictionary of FASTA indexing settings read from the config, e.g
+#     {'min_file_mb': 256, 'workers': 4, 'index_dir': 'C:\tmp\springs_upload\fasta_index'}
+# A min_file_mb of 0 turns indexing off.
+def get_fasta_index_options(config):
+    return {
+        'min_file_mb': float(get_config_option(config, DNA_SEQUENCE_SECTION, 'index_min_file_mb', '0')),
+        'workers': int(get_config_option(config, DNA_SEQUENCE_SECTION, 'index_workers', str(multiprocessing.cpu_count()))),
+        'index_dir': get_config_option(config, DNA_SEQUENCE_SECTION, 'index_dir', '')
+    }
+
+# Returns True if the given FASTA file should be read via an index. Compressed
+# files can't be memory mapped, so are always streamed.
+def use_fasta_index(fasta_file, index_options):
+    if index_options['min_file_mb'] <= 0 or os.path.splitext(fasta_file)[1].lower() in COMPRESSED_FILE_TYPES:
+        return False
+    file_size = os.path.getsize(fasta_file)
+    return file_size > 0 and file_size >= index_options['min_file_mb'] * 1024 * 1024
+
+# Returns the path the index of the given FASTA file is saved to. Without an
+# index_dir, indexes are saved in the staging directory (if there is one), as
+# the FASTA file itself is moved to the archive once it's processed. Indexes
+# are named after the FASTA file and check its size and modification time, so
+# the same file dropped again uses its saved index.
+def get_fasta_index_file(fasta_file, index_options):
+    index_dir = index_options['index_dir']
+    if not index_dir:
+        index_dir = os.path.join(staging_dir, 'fasta_index') if staging_dir is not None else os.path.dirname(fasta_file)
+    return os.path.join(index_dir, os.path.basename(fasta_file) + '.fai')
+
+# Returns the index of the given FASTA file, loading it from disk if a saved
+# index exists for the current version of the file, otherwise building and
+# saving a new index. The index is a list of tuples in the form
+#     (otu_id, sequence length, sequence start offset, sequence end offset)
+def get_fasta_index(fasta_file, index_options):
+    index_file = get_fasta_index_file(fasta_file, index_options)
+    fasta_index = load_fasta_index(fasta_file, index_file)
+    if fasta_index is None:
+        fasta_index = build_fasta_index(fasta_file, index_options['workers'])
+        save_fasta_index(fasta_file, index_file, fasta_index)
+    else:
+        log.info('Using saved FASTA index ' + index_file)
+
+    return fasta_index
+
+# Returns a string identifying the current version of the given file
+def get_file_signature(file_path):
+    file_stat = os.stat(file_path)
+    return str(file_stat.st_size) + ':' + str(int(file_stat.st_mtime))
 
-def init_taxonomy_overview_cache(host, db_conn):
+# Returns the saved index of the given FASTA file, or None if there is no
+# saved index or the file has changed since it was indexed
+def load_fasta_index(fasta_file, index_file):
+    if not os.path.isfile(index_file):
+        return None
+
+    with open(index_file) as f:
+        if f.readline().strip() != '#' + get_file_signature(fasta_file):
+            return None
+        fasta_index = []
+        for line in f:
+            otu_id, length, start, end = line.rstrip('\n').split('\t')
+            fasta_index.append((otu_id, int(length), int(start), int(end)))
+
+    return fasta_index
+
+def save_fasta_index(fasta_file, index_file, fasta_index):
+    try:
+        index_dir = os.path.dirname(index_file)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        with open(index_file, 'w') as f:
+            f.write('#' + get_file_signature(fasta_file) + '\n')
+            for entry in fasta_index:
+                f.write('\t'.join(map(str, entry)) + '\n')
+        log.info('Saved FASTA index ' + index_file)
+
+    except Exception as e:
+        # The index is only an optimisation, carry on without it
+        log.warn('Unable to save FASTA index ' + index_file + ': ' + str(e))
+
+# Splits the given FASTA file into record aligned chunks and indexes the
+# chunks in parallel. Returns the index in the form described in
+# get_fasta_index().
+def build_fasta_index(fasta_file, worker_count):
+    start_time = time.time()
+    file_size = os.path.getsize(fasta_file)
+    chunk_count = max(max(1, worker_count) * 4, file_size / FASTA_MAX_CHUNK_BYTES + 1)
+    with open(fasta_file, 'rb') as f:
+        if f.read(1) != '>':
+            raise Exception('FASTA file ' + fasta_file + ' does not start with a header line')
+        chunks = get_fasta_chunks(f, file_size, chunk_count)
+
+    chunk_args = [(fasta_file, chunk_start, chunk_end) for chunk_start, chunk_end in chunks]
+    if worker_count > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(worker_count, len(chunks)))
+        try:
+            chunk_indexes = pool.map(index_fasta_chunk, chunk_args)
+        finally:
+            pool.terminate()
+    else:
+        chunk_indexes = map(index_fasta_chunk, chunk_args)
+
+    fasta_index = [entry for chunk_index in chunk_indexes for entry in chunk_index]
+    log.info('Indexed ' + str(len(fasta_index)) + ' sequences in ' + fasta_file + ' using '
+        + str(len(chunks)) + ' chunks in ' + format_elapsed(start_time))
+    return fasta_index
+
+# f: open FASTA file, of file_size bytes
+#
+# Returns a list of (start offset, end offset) tuples splitting the FASTA file
+# into about chunk_count chunks, each starting on a header line
+def get_fasta_chunks(f, file_size, chunk_count):
+    chunk_size = max(1, file_size / chunk_count)
+    chunks = []
+    chunk_start = 0
+    while chunk_start < file_size:
+        next_header = find_fasta_header(f, chunk_start + chunk_size - 1)
+        chunk_end = file_size if next_header < 0 else next_header + 1
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+
+    return chunks
+
+# Returns the offset of the first '\n>' at or after the given offset of the
+# open FASTA file, or -1 if there isn't one
+def find_fasta_header(f, offset):
+    f.seek(offset)
+    data_start = offset
+    data = ''
+    while True:
+        block = f.read(1048576)
+        if block == '':
+            return -1
+        data = data[-1:] + block
+        header_start = data.find('\n>')
+        if header_start >= 0:
+            return data_start + header_start
+        data_start += len(data) - 1
+
+# chunk_args: tuple of (FASTA file path, chunk start offset, chunk end offset),
+#             the chunk must start with a header line
+#
+# Indexes the records in one chunk of a FASTA file. Only the chunk is memory
+# mapped, from the allocation boundary before it. Runs in a worker process,
+# so takes a single picklable argument.
+def index_fasta_chunk(chunk_args):
+    fasta_file, chunk_start, chunk_end = chunk_args
+    map_start = chunk_start - chunk_start % mmap.ALLOCATIONGRANULARITY
+    chunk_index = []
+    with open(fasta_file, 'rb') as f:
+        fasta_map = mmap.mmap(f.fileno(), chunk_end - map_start, access=mmap.ACCESS_READ, offset=map_start)
+        try:
+            # offsets within the map
+            record_start = chunk_start - map_start
+            map_end = chunk_end - map_start
+            while record_start < map_end:
+                header_end = fasta_map.find('\n', record_start, map_end)
+                if header_end < 0:
+                    header_end = map_end
+                header = fasta_map[record_start:header_end].strip()
+                otu_id_line = OTU_ID_LINE_RE.match(header)
+                if not otu_id_line:
+                    raise Exception('Unexpected FASTA header "' + header[:100] + '" in ' + fasta_file + ' at offset ' + str(map_start + record_start))
+
+                next_header = fasta_map.find('\n>', header_end, map_end)
+                record_end = map_end if next_header < 0 else next_header + 1
+                sequence_start = min(header_end + 1, record_end)
+                sequence_data = fasta_map[sequence_start:record_end]
+                sequence_length = len(sequence_data) - sequence_data.count('\n') - sequence_data.count('\r')
+                chunk_index.append((otu_id_line.group(1), sequence_length, map_start + sequence_start, map_start + record_end))
+                record_start = record_end
+        finally:
+            fasta_map.close()
+
+    return chunk_index
+
+# otu_ids: set of upper case OTU ids of the sequences to read, or None for all
+#
+# Generator returning an (otu_id, dna_sequence) tuple for each entry in the
+# given index, reading just the sequences wanted from the FASTA file. The
+# sequences of other OTUs are returned as None, without reading them.
+def read_indexed_fasta_records(fasta_file, fasta_index, otu_ids=None):
+    with open(fasta_file, 'rb') as f:
+        for otu_id, sequence_length, sequence_start, sequence_end in fasta_index:
+            if otu_ids is not None and otu_id.upper() not in otu_ids:
+                yield otu_id, None
+                continue
+            f.seek(sequence_start)
+            yield otu_id, ''.join(f.read(sequence_end - sequence_start).split())
+
+#-------------------------------------------------------------------------------
+# TAXONOMY SUMMARY TABLES
+#-------------------------------------------------------------------------------
+# The website's taxonomy summary and overview pages aggregate sample_taxonomy
+# read counts by rank. Rather than have the website do that on every request,
+# the aggregates are materialized here after each taxonomy upload, with a
+# GROUP BY pass per rank.
+
+TAXONOMY_RANKS = ['domain', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+TAXONOMY_OVERVIEW_RANKS = ['domain', 'phylum']
+
+# Read counts per sample, rank and taxon. OTUs not classified at a rank are
+# counted under an empty taxon_name.
+TAXONOMY_SAMPLE_SUMMARY_DDL = (
+    'create table if not exists taxonomy_sample_summary ('
+    ' sample_id int not null,'
+    ' rank_name varchar(16) not null,'
+    ' taxon_name varchar(255) not null,'
+    ' read_count bigint not null,'
+    ' otu_count int not null,'
+    ' primary key (sample_id, rank_name, taxon_name))')
+
+# Read counts of each domain and phylum per sample, with the fraction of the
+# sample's reads they account for, keyed for lookup by taxon
+TAXONOMY_OVERVIEW_SUMMARY_DDL = (
+    'create table if not exists taxonomy_overview_summary ('
+    ' rank_name varchar(16) not null,'
+    ' taxon_name varchar(255) not null,'
+    ' sample_id int not null,'
+    ' read_count bigint not null,'
+    ' read_fraction double not null,'
+    ' primary key (rank_name, taxon_name, sample_id),'
+    ' index taxonomy_overview_summary_sample (sample_id))')
+
+# taxonomy_changes: dictionary in the form returned by new_taxonomy_changes()
+# rebuild: True to rebuild the tables whatever has changed
+#
+# Rebuilds the summary tables after a full taxonomy reload, otherwise
+# recalculates just the rows of samples whose taxonomy changed.
+def update_taxonomy_summary_tables(db_conn, taxonomy_changes, rebuild, batch_size=1000):
+    start_time = time.time()
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(TAXONOMY_SAMPLE_SUMMARY_DDL)
+        cursor.execute(TAXONOMY_OVERVIEW_SUMMARY_DDL)
+        if rebuild or taxonomy_changes['full_reload']:
+            rebuild_taxonomy_summary_tables(db_conn, cursor)
+            log.info('Rebuilt taxonomy summary tables in ' + format_elapsed(start_time))
+        elif len(taxonomy_changes['sample_numbers']) > 0:
+            sample_ids = get_sample_ids(cursor, sorted(taxonomy_changes['sample_numbers']), batch_size).values()
+            for batch_start in xrange(0, len(sample_ids), batch_size):
+                batch = sample_ids[batch_start:batch_start + batch_size]
+                with db_conn:
+                    id_params = ','.join(['%s'] * len(batch))
+                    cursor.execute('delete from taxonomy_overview_summary where sample_id in (' + id_params + ')', batch)
+                    cursor.execute('delete from taxonomy_sample_summary where sample_id in (' + id_params + ')', batch)
+                    insert_taxonomy_summaries(cursor, 'taxonomy_sample_summary', 'taxonomy_overview_summary', batch)
+            log.info('Updated taxonomy summary tables for ' + str(len(sample_ids)) + ' samples in ' + format_elapsed(start_time))
+    finally:
+        cursor.close()
+
+# Builds the summary tables in staging tables, then swaps them in
+def rebuild_taxonomy_summary_tables(db_conn, cursor):
+    try:
+        sample_summary_indexes = create_staging_table(cursor, 'taxonomy_sample_summary')
+        overview_summary_indexes = create_staging_table(cursor, 'taxonomy_overview_summary')
+        with db_conn:
+            insert_taxonomy_summaries(cursor, 'taxonomy_sample_summary_new', 'taxonomy_overview_summary_new')
+        add_table_indexes(cursor, 'taxonomy_sample_summary_new', sample_summary_indexes)
+        add_table_indexes(cursor, 'taxonomy_overview_summary_new', overview_summary_indexes)
+        swap_staging_tables(cursor, ['taxonomy_sample_summary', 'taxonomy_overview_summary'])
+    finally:
+        cursor.execute('drop table if exists taxonomy_sample_summary_new, taxonomy_overview_summary_new')
+
+# sample_ids: ids of the samples to summarise, or None for all samples
+#
+# Inserts the summary rows of the given samples into the given tables. The
+# overview rows are calculated from the sample summary rows just inserted.
+def insert_taxonomy_summaries(cursor, sample_summary_table, overview_summary_table, sample_ids=None):
+    sample_filter = ''
+    if sample_ids is not None:
+        sample_filter = ' where st.sample_id in (' + ','.join(['%s'] * len(sample_ids)) + ')'
+
+    for rank in TAXONOMY_RANKS:
+        cursor.execute(
+            'insert into ' + sample_summary_table + ' (sample_id, rank_name, taxon_name, read_count, otu_count)'
+            ' select st.sample_id, %s, coalesce(t.`' + rank + '`, \'\'), sum(st.read_count), count(*)'
+            ' from sample_taxonomy st join taxonomy t on t.id=st.taxonomy_id' + sample_filter +
+            ' group by st.sample_id, coalesce(t.`' + rank + '`, \'\')',
+            [rank] + (sample_ids or []))
+
+    total_filter = sample_filter.replace(' where st.', ' and ')
+    cursor.execute(
+        'insert into ' + overview_summary_table + ' (rank_name, taxon_name, sample_id, read_count, read_fraction)'
+        ' select s.rank_name, s.taxon_name, s.sample_id, s.read_count, s.read_count / totals.read_count'
+        ' from ' + sample_summary_table + ' s'
+        ' join (select sample_id, sum(read_count) read_count from ' + sample_summary_table +
+        '  where rank_name=\'domain\'' + total_filter + ' group by sample_id) totals on totals.sample_id=s.sample_id'
+        ' where s.rank_name in (' + ','.join(['%s'] * len(TAXONOMY_OVERVIEW_RANKS)) + ')'
+        ' and s.taxon_name <> \'\' and totals.read_count > 0',
+        (sample_ids or []) + TAXONOMY_OVERVIEW_RANKS)
+
+#-------------------------------------------------------------------------------
+# TAXONOMY JSON EXPORT
+#-------------------------------------------------------------------------------
+# Renders the taxonomy summary and overview JSON for every public sample and
+# taxon from the summary tables, and publishes it to S3 as gzipped static
+# files. Only objects whose content changed are uploaded.
+
+JSON_EXPORT_SECTION = 'JsonExport'
+
+def get_json_export_options(config):
+    return {
+        'enabled': get_config_option(config, JSON_EXPORT_SECTION, 'enabled', 'false').lower() == 'true',
+        's3_folder': get_config_option(config, JSON_EXPORT_SECTION, 's3_folder', 'taxonomy'),
+        'max_age': int(get_config_option(config, JSON_EXPORT_SECTION, 'max_age', '3600'))
+    }
+
+# s3_bucket: S3 bucket to publish to, or None to connect to the configured bucket
+#
+# Publishes the taxonomy JSON to S3, in the form
+#     [s3_folder]/taxonomyJson/[sample_number].json
+#     [s3_folder]/overviewTaxonGraphJson/[rank]/[taxon_name].json
+# mirroring the website URLs. Objects for samples or taxa which are no longer
+# public are deleted. Returns a summary of the changes.
+def export_taxonomy_json(config, db_conn, json_options, s3_bucket=None):
+    start_time = time.time()
+    if s3_bucket is None:
+        s3_bucket = get_s3_bucket(config)
+    key_prefix = json_options['s3_folder'] + '/'
+    existing_etags = dict([(key.name, key.etag.strip('"')) for key in s3_bucket.list(prefix=key_prefix)])
+
+    # Render everything before uploading, so the database cursors aren't held open during uploads
+    changed_objects = []
+    object_count = 0
+    published_keys = set()
+    for path, payload in get_taxonomy_json(db_conn):
+        # paths are website URL paths, so already start with a '/' and have encoded names
+        key_name = key_prefix + path.lstrip('/') + '.json'
+        content = gzip_json(payload)
+        object_count += 1
+        published_keys.add(key_name)
+        if existing_etags.get(key_name) != hashlib.md5(content).hexdigest():
+            changed_objects.append((key_name, content))
+
+    for key_name, content in changed_objects:
+        upload_json(s3_bucket, key_name, content, json_options['max_age'])
+
+    removed_keys = [k for k in existing_etags if k not in published_keys]
+    if len(removed_keys) > 0:
+        s3_bucket.delete_keys(removed_keys)
+
+    summary = ('Published taxonomy JSON in ' + format_elapsed(start_time) + ': ' + str(len(changed_objects)) + ' of '
+        + str(object_count) + ' objects changed, ' + str(len(removed_keys)) + ' removed')
+    log.info(summary)
+    return summary
+
+# Yields a (path, payload) tuple for each taxonomy summary and overview JSON
+# object, where path is the website URL path of the same data
+def get_taxonomy_json(db_conn):
+    for path, payload in get_taxonomy_summary_json(db_conn):
+        yield path, payload
+    for path, payload in get_taxonomy_overview_json(db_conn):
+        yield path, payload
+
+# Yields a (path, payload) tuple per public sample, where payload is in the form
+#     {'sample_number': 'P1.0001', 'ranks': {'domain': [{'name': 'Bacteria', 'read_count': 1234, 'otu_count': 56}, ...], ...}}
+# with the taxa of each rank in descending read count order
+def get_taxonomy_summary_json(db_conn):
+    cursor = db_conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(
+            'select p.sample_number, ss.rank_name, ss.taxon_name, ss.read_count, ss.otu_count'
+            ' from taxonomy_sample_summary ss'
+            ' join sample s on s.id=ss.sample_id'
+            ' join public_sample p on p.sample_number=s.sample_number'
+            ' order by p.sample_number, ss.rank_name, ss.read_count desc, ss.taxon_name')
+        payload = None
+        for sample_number, rank, taxon_name, read_count, otu_count in cursor:
+            if payload is None or payload['sample_number'] != sample_number:
+                if payload is not None:
+                    yield get_summary_cache_path(payload['sample_number']), payload
+                payload = {'sample_number': sample_number, 'ranks': {}}
+            payload['ranks'].setdefault(rank, []).append({'name': taxon_name, 'read_count': read_count, 'otu_count': otu_count})
+        if payload is not None:
+            yield get_summary_cache_path(payload['sample_number']), payload
+    finally:
+        cursor.close()
+
+# Yields a (path, payload) tuple per domain and phylum found in public samples, where payload is in the form
+#     {'rank': 'phylum', 'name': 'Aquificae', 'samples': [{'sample_number': 'P1.0001', 'read_count': 1234, 'read_fraction': 0.25}, ...]}
+def get_taxonomy_overview_json(db_conn):
+    cursor = db_conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(
+            'select os.rank_name, os.taxon_name, p.sample_number, os.read_count, os.read_fraction'
+            ' from taxonomy_overview_summary os'
+            ' join sample s on s.id=os.sample_id'
+            ' join public_sample p on p.sample_number=s.sample_number'
+            ' order by os.rank_name, os.taxon_name, p.sample_number')
+        payload = None
+        for rank, taxon_name, sample_number, read_count, read_fraction in cursor:
+            if payload is None or payload['rank'] != rank or payload['name'] != taxon_name:
+                if payload is not None:
+                    yield get_overview_cache_path(payload['rank'], payload['name']), payload
+                payload = {'rank': rank, 'name': taxon_name, 'samples': []}
+            payload['samples'].append({'sample_number': sample_number, 'read_count': read_count, 'read_fraction': read_fraction})
+        if payload is not None:
+            yield get_overview_cache_path(payload['rank'], payload['name']), payload
+    finally:
+        cursor.close()
+
+# Returns the given payload as gzipped JSON. The output only depends on the
+# payload (no timestamp in the gzip header), so unchanged payloads produce
+# unchanged content and S3 ETags.
+def gzip_json(payload):
+    buf = cStringIO.StringIO()
+    f = gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0)
+    try:
+        f.write(json.dumps(payload, sort_keys=True, separators=(',', ':')))
+    finally:
+        f.close()
+    return buf.getvalue()
+
+def upload_json(s3_bucket, key_name, content, max_age):
+    from boto.s3.key import Key
+    log.debug('Uploading ' + key_name)
+    key = Key(s3_bucket)
+    key.key = key_name
+    key.metadata.update({
+        'Content-Type': 'application/json',
+        'Content-Encoding': 'gzip',
+        'Cache-Control': 'max-age=' + str(max_age)
+    })
+    key.set_contents_from_string(content, policy='public-read')
+
+#-------------------------------------------------------------------------------
+# CACHE OPERATIONS
+#-------------------------------------------------------------------------------
+WEBSITE_SECTION = 'Website'
+
+# Returns a dictionary of cache warming settings read from the config, e.g
+#     {'concurrency': 4, 'timeout': 120.0, 'retries': 2, 'target_latency': 2.0,
+#      'initial_delay': 1.0, 'max_delay': 10.0}
+def get_cache_warming_options(config):
+    return {
+        'concurrency': max(1, int(get_config_option(config, WEBSITE_SECTION, 'warm_concurrency', '1'))),
+        'timeout': float(get_config_option(config, WEBSITE_SECTION, 'warm_timeout', '120')),
+        'retries': int(get_config_option(config, WEBSITE_SECTION, 'warm_retries', '2')),
+        'target_latency': float(get_config_option(config, WEBSITE_SECTION, 'warm_target_latency', '2')),
+        'initial_delay': float(get_config_option(config, WEBSITE_SECTION, 'warm_initial_delay', '1')),
+        'max_delay': float(get_config_option(config, WEBSITE_SECTION, 'warm_max_delay', '10')),
+        'checkpoint_file': get_config_option(config, WEBSITE_SECTION, 'warm_checkpoint_file',
+            os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache_warm_checkpoint.txt'))
+    }
+
+def init_caches(host, db_conn, warm_options):
+    return init_taxonomy_overview_cache(host, db_conn, warm_options) + init_taxonomy_summary_cache(host, db_conn, warm_options)
+
+def init_taxonomy_overview_cache(host, db_conn, warm_options):
     log.info('Initialising taxonomy overview cache')
     domains = get_single_column(db_conn, 'select distinct domain from public_taxonomy order by domain')
     phylums = get_single_column(db_conn, 'select distinct phylum from public_taxonomy order by phylum')
 
-    for domain in domains:
-        http_get(host, '/overviewTaxonGraphJson/domain/'+domain)
-        time.sleep(1) # sleep for 1 second to give the DB a breather
-
-    for phylum in phylums:
-        http_get(host, '/overviewTaxonGraphJson/phylum/'+phylum)
-        time.sleep(1)
+    paths = [get_overview_cache_path('domain', domain) for domain in domains]
+    paths += [get_overview_cache_path('phylum', phylum) for phylum in phylums]
+    return warm_urls(host, paths, warm_options)
 
-def init_taxonomy_summary_cache(host, db_conn):
+def init_taxonomy_summary_cache(host, db_conn, warm_options):
     log.info('Initialising taxonomy summary cache')
     sample_numbers = get_single_column(db_conn, 'select sample_number from public_sample s order by sample_number')
-    for sample_number in sample_numbers:
-        http_get(host, '/taxonomyJson/'+sample_number)
-        time.sleep(5) # sleep for 5 seconds to give the DB a breather
+    return warm_urls(host, [get_summary_cache_path(s) for s in sample_numbers], warm_options)
+
+# Returns an empty record of the cache entries to refresh, in the form
+#     {
+#        'full_overview': True if the whole taxonomy overview cache is to be reloaded,
+#        'full_summary': True if the whole taxonomy summary cache is to be reloaded,
+#        'sample_numbers': set of samples whose taxonomy summary is to be refreshed,
+#        'domains': set of domains whose overview is to be refreshed,
+#        'phyla': set of phyla whose overview is to be refreshed
+#     }
+def new_cache_scope():
+    return {
+        'full_overview': False,
+        'full_summary': False,
+        'sample_numbers': set(),
+        'domains': set(),
+        'phyla': set()
+    }
+
+def is_cache_scope_empty(cache_scope):
+    return not (cache_scope['full_overview'] or cache_scope['full_summary']
+        or cache_scope['sample_numbers'] or cache_scope['domains'] or cache_scope['phyla'])
+
+# taxonomy_changes: dictionary in the form returned by new_taxonomy_changes()
+# sample_numbers: samples uploaded from sample files
+# reload_caches: True if the whole of both caches is to be reloaded
+#
+# Works out which cache entries are affected by the data uploaded. Taxonomy
+# summaries depend on the taxonomy data only, while the overviews also depend
+# on which samples exist, so new or updated samples refresh the overviews of
+# the domains and phyla found in them.
+# Returns a dictionary in the form returned by new_cache_scope().
+def get_cache_scope(db_conn, taxonomy_changes, sample_numbers, reload_caches):
+    cache_scope = new_cache_scope()
+    if reload_caches or taxonomy_changes['full_reload']:
+        cache_scope['full_overview'] = True
+        cache_scope['full_summary'] = True
+        return cache_scope
+
+    cache_scope['sample_numbers'].update(taxonomy_changes['sample_numbers'])
+    cache_scope['domains'].update(taxonomy_changes['domains'])
+    cache_scope['phyla'].update(taxonomy_changes['phyla'])
+
+    if len(sample_numbers) > 0:
+        domains, phyla = get_sample_taxa(db_conn, list(sample_numbers))
+        cache_scope['domains'].update(domains)
+        cache_scope['phyla'].update(phyla)
+
+    return cache_scope
+
+# Returns a tuple of (list of domains, list of phyla) found in the given samples
+def get_sample_taxa(db_conn, sample_numbers, batch_size=1000):
+    domains = set()
+    phyla = set()
+    cursor = db_conn.cursor()
+    try:
+        for batch_start in xrange(0, len(sample_numbers), batch_size):
+            batch = sample_numbers[batch_start:batch_start + batch_size]
+            cursor.execute(
+                'select distinct t.domain, t.phylum from taxonomy t'
+                ' join sample_taxonomy st on st.taxonomy_id=t.id'
+                ' join sample s on s.id=st.sample_id'
+                ' where s.sample_number in (' + ','.join(['%s'] * len(batch)) + ')',
+                batch)
+            for domain, phylum in cursor.fetchall():
+                if domain is not None:
+                    domains.add(domain)
+                if phylum is not None:
+                    phyla.add(phylum)
+    finally:
+        cursor.close()
+
+    return list(domains), list(phyla)
+
+# cache_scope: dictionary in the form returned by new_cache_scope()
+# fill_caches: True if every cache entry is to be requested, even if unchanged
+# resume: True to skip the URLs completed by an earlier, unfinished refresh,
+#         as long as the data hasn't changed since
+# use_checkpoint: True to record progress in the checkpoint file so the refresh
+#         can be resumed. Only worth doing for full fill or reload runs.
+#
+# Clears and re-requests the website cache entries in the given scope. Where
+# only some samples or taxa changed, only their entries are cleared (using the
+# website's per-entry clear URLs) and re-requested.
+# Returns a summary of the refresh for the notification email.
+def refresh_taxonomy_caches(host, db_conn, cache_scope, fill_caches, warm_options, resume=False, use_checkpoint=False):
+    if use_checkpoint:
+        checkpoint = open_cache_checkpoint(warm_options['checkpoint_file'], get_cache_snapshot_marker(db_conn), resume)
+    else:
+        checkpoint = open_cache_checkpoint(None, None, False)
+    try:
+        return refresh_taxonomy_caches_with_checkpoint(host, db_conn, cache_scope, fill_caches, warm_options, checkpoint)
+    finally:
+        close_cache_checkpoint(checkpoint)
+
+def refresh_taxonomy_caches_with_checkpoint(host, db_conn, cache_scope, fill_caches, warm_options, checkpoint):
+    resumed_count = len(checkpoint['completed'])
+    public_domains = get_single_column(db_conn, 'select distinct domain from public_taxonomy order by domain')
+    public_phyla = get_single_column(db_conn, 'select distinct phylum from public_taxonomy order by phylum')
+    public_sample_numbers = get_single_column(db_conn, 'select sample_number from public_sample s order by sample_number')
+    full_url_count = len(public_domains) + len(public_phyla) + len(public_sample_numbers)
+
+    # Overview cache
+    if cache_scope['full_overview']:
+        clear_cache(host, '/clearTaxonomyOverviewCache', checkpoint)
+    else:
+        clear_paths = ['/clearTaxonomyOverviewCache/domain/' + quote_url_part(d) for d in sorted(cache_scope['domains'])]
+        clear_paths += ['/clearTaxonomyOverviewCache/phylum/' + quote_url_part(p) for p in sorted(cache_scope['phyla'])]
+        warm_urls(host, clear_paths, warm_options, checkpoint)
+
+    if fill_caches or cache_scope['full_overview']:
+        overview_domains, overview_phyla = public_domains, public_phyla
+    else:
+        # Taxa no longer in the public data just need clearing
+        overview_domains = [d for d in public_domains if d in cache_scope['domains']]
+        overview_phyla = [p for p in public_phyla if p in cache_scope['phyla']]
+    warm_paths = [get_overview_cache_path('domain', d) for d in overview_domains]
+    warm_paths += [get_overview_cache_path('phylum', p) for p in overview_phyla]
+
+    # Summary cache
+    if cache_scope['full_summary']:
+        clear_cache(host, '/clearTaxonomyCache', checkpoint)
+    else:
+        warm_urls(host, ['/clearTaxonomyCache/' + quote_url_part(s) for s in sorted(cache_scope['sample_numbers'])], warm_options, checkpoint)
+
+    if fill_caches or cache_scope['full_summary']:
+        summary_sample_numbers = public_sample_numbers
+    else:
+        summary_sample_numbers = [s for s in public_sample_numbers if s in cache_scope['sample_numbers']]
+    warm_paths += [get_summary_cache_path(s) for s in summary_sample_numbers]
+
+    log.info('Refreshing ' + str(len(overview_domains)) + ' domain, ' + str(len(overview_phyla)) + ' phylum and '
+        + str(len(summary_sample_numbers)) + ' sample cache entries')
+    warm_results = warm_urls(host, warm_paths, warm_options, checkpoint)
+
+    skipped_count = full_url_count - len(warm_results)
+    summary = (get_warm_summary(warm_results) + '\n' + str(skipped_count) + ' of ' + str(full_url_count)
+        + ' URLs skipped compared with a full cache refill')
+    if resumed_count > 0:
+        summary += ' (including URLs completed by the run being resumed)'
+    log.info(summary)
+    return summary
+
+# Each taxonomy or DNA sequence load adds a row to taxonomy_load before it
+# changes any data, so the snapshot marker changes with every load (even one
+# which only renames taxa), and a load which fails part way still invalidates
+# any checkpoint.
+TAXONOMY_LOAD_DDL = (
+    'create table if not exists taxonomy_load ('
+    ' id int not null auto_increment,'
+    ' data_file_name varchar(255) not null,'
+    ' loaded_at datetime not null,'
+    ' primary key (id))')
+
+def record_taxonomy_load(db_conn, data_file_name):
+    with db_conn:
+        cursor = db_conn.cursor()
+        cursor.execute(TAXONOMY_LOAD_DDL)
+        cursor.execute('insert into taxonomy_load (data_file_name, loaded_at) values (%s, now())', [data_file_name])
+
+# Returns a string which changes whenever the data behind the taxonomy caches
+# changes, used to tell whether a checkpoint is still valid
+def get_cache_snapshot_marker(db_conn):
+    cursor = db_conn.cursor()
+    try:
+        cursor.execute(TAXONOMY_LOAD_DDL)
+        cursor.execute(
+            'select (select coalesce(max(id), 0) from taxonomy_load),'
+            ' (select count(*) from public_sample), (select coalesce(max(id), 0) from sample)')
+        return ':'.join([str(v) for v in cursor.fetchone()])
+    finally:
+        cursor.close()
+
+# checkpoint_file: file that records the progress of cache refreshes. The first
+#     line holds the data snapshot marker, followed by one line per URL completed.
+#     None to only track progress in memory.
+# snapshot_marker: value returned by get_cache_snapshot_marker()
+# resume: True to carry on from the existing checkpoint if the data hasn't changed
+#
+# Returns a checkpoint dictionary in the form
+#     {'file': open checkpoint file, 'lock': lock for writing, 'completed': set of completed URL paths}
+def open_cache_checkpoint(checkpoint_file, snapshot_marker, resume):
+    completed = set()
+    if checkpoint_file is None:
+        return {'file': None, 'lock': threading.Lock(), 'completed': completed}
+
+    if resume and os.path.isfile(checkpoint_file):
+        with open(checkpoint_file) as f:
+            if f.readline().strip() == '#' + snapshot_marker:
+                completed = set([line.strip() for line in f if line.strip()])
+                log.info('Resuming cache refresh, ' + str(len(completed)) + ' URLs already completed')
+            else:
+                log.info('Data has changed since the cache refresh checkpoint was written, starting from scratch')
+    elif resume:
+        log.info('No cache refresh checkpoint found at ' + checkpoint_file + ', starting from scratch')
+
+    checkpoint_dir = os.path.dirname(checkpoint_file)
+    if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    if len(completed) > 0:
+        f = open(checkpoint_file, 'a')
+    else:
+        f = open(checkpoint_file, 'w')
+        f.write('#' + snapshot_marker + '\n')
+        f.flush()
+
+    return {'file': f, 'lock': threading.Lock(), 'completed': completed}
+
+# Records the given URL path as completed
+def record_cache_checkpoint(checkpoint, path):
+    with checkpoint['lock']:
+        if checkpoint['file'] is not None:
+            checkpoint['file'].write(path + '\n')
+            checkpoint['file'].flush()
+        checkpoint['completed'].add(path)
+
+def close_cache_checkpoint(checkpoint):
+    if checkpoint['file'] is not None:
+        checkpoint['file'].close()
+
+# Requests a whole-cache clear URL, unless already done by the run being resumed
+def clear_cache(host, path, checkpoint):
+    if path not in checkpoint['completed']:
+        if http_get(host, path) < 400:
+            record_cache_checkpoint(checkpoint, path)
+
+# rank: 'domain' or 'phylum'
+def get_overview_cache_path(rank, taxon_name):
+    return '/overviewTaxonGraphJson/' + rank + '/' + quote_url_part(taxon_name)
+
+def get_summary_cache_path(sample_number):
+    return '/taxonomyJson/' + quote_url_part(sample_number)
+
+def quote_url_part(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe='')
+
+# host: website host name, optionally with a port, e.g 'localhost:8080'
+# paths: list of URL paths to request
+# warm_options: dictionary in the form returned by get_cache_warming_options()
+# checkpoint: dictionary in the form returned by open_cache_checkpoint(), or None.
+#     Paths already completed are skipped, and successful requests are recorded.
+#
+# Requests each of the given paths from the website so it caches the results.
+# Up to warm_options['concurrency'] requests are made at a time, each worker
+# re-using a single keep-alive connection. Failed requests are retried. The
+# number of requests in flight and the spacing between them are adjusted as
+# the website's response times change, see new_rate_controller().
+# Returns a list with a dictionary per path requested, in the form
+#     {'path': '/taxonomyJson/P1.0001', 'status': 200, 'latency': 1.25, 'attempts': 1, 'error': None}
+# where status is None if no response was received.
+def warm_urls(host, paths, warm_options, checkpoint=None):
+    start_time = time.time()
+    if checkpoint is not None:
+        paths = [p for p in paths if p not in checkpoint['completed']]
+    path_queue = Queue.Queue()
+    for path in paths:
+        path_queue.put(path)
+    results = []
+    rate_controller = new_rate_controller(warm_options)
+
+    def warm_worker():
+        conn = None
+        try:
+            while True:
+                try:
+                    path = path_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                acquire_rate_permit(rate_controller)
+                result, conn = warm_url(host, conn, path, warm_options)
+                release_rate_permit(rate_controller, result)
+                results.append(result)
+                if checkpoint is not None and result['status'] is not None and result['status'] < 400:
+                    record_cache_checkpoint(checkpoint, path)
+                log.debug('HTTP get: http://' + host + path + ' ' + str(result['status'])
+                    + (' in %.2fs' % result['latency'] if result['latency'] is not None else ' ' + str(result['error'])))
+        finally:
+            if conn is not None:
+                conn.close()
+
+    threads = []
+    for i in range(min(warm_options['concurrency'], len(paths))):
+        thread = threading.Thread(target=warm_worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    log.info('Requested ' + str(len(paths)) + ' URLs in ' + format_elapsed(start_time) + ': ' + get_warm_summary(results))
+    return results
+
+# Returns a new rate controller for cache warming requests. The controller
+# uses additive increase, multiplicative decrease (as TCP congestion control
+# does): while responses come back within the target latency the number of
+# concurrent requests slowly grows and the pause between requests shrinks.
+# A slow or failed response halves the concurrency and doubles the pause.
+def new_rate_controller(warm_options):
+    return {
+        'condition': threading.Condition(),
+        'max_concurrency': warm_options['concurrency'],
+        'target_latency': warm_options['target_latency'],
+        'max_delay': warm_options['max_delay'],
+        'concurrency': 1.0,
+        'delay': float(min(warm_options['initial_delay'], warm_options['max_delay'])),
+        'active': 0,
+        'next_request_time': 0,
+        'last_decrease_time': 0
+    }
+
+# Blocks until the rate controller allows another request to start
+def acquire_rate_permit(rate_controller):
+    condition = rate_controller['condition']
+    with condition:
+        while True:
+            wait_time = rate_controller['next_request_time'] - time.time()
+            if rate_controller['active'] < int(rate_controller['concurrency']) and wait_time <= 0:
+                break
+            condition.wait(wait_time if wait_time > 0 else None)
+
+        rate_controller['active'] += 1
+        rate_controller['next_request_time'] = time.time() + rate_controller['delay']
+
+# result: result of the completed request, as described in warm_urls()
+#
+# Releases a request's permit and adjusts the request rate based on how the
+# request went.
+def release_rate_permit(rate_controller, result):
+    condition = rate_controller['condition']
+    with condition:
+        rate_controller['active'] -= 1
+        old_concurrency = int(rate_controller['concurrency'])
+        old_delay = rate_controller['delay']
+        now = time.time()
+        failed = result['status'] is None or result['status'] >= 500
+        slow = result['latency'] is not None and result['latency'] > rate_controller['target_latency']
+        if failed or slow:
+            # Back off at most once per target latency period, so a burst of
+            # slow responses to requests already in flight counts only once
+            if now - rate_controller['last_decrease_time'] > rate_controller['target_latency']:
+                rate_controller['last_decrease_time'] = now
+                rate_controller['concurrency'] = max(1.0, rate_controller['concurrency'] / 2.0)
+                rate_controller['delay'] = min(rate_controller['max_delay'], max(rate_controller['delay'] * 2, 0.5))
+                rate_controller['next_request_time'] = now + rate_controller['delay']
+                if int(rate_controller['concurrency']) != old_concurrency or rate_controller['delay'] != old_delay:
+                    reason = ('error ' + str(result['status'] or result['error'])) if failed else (
+                        'latency %.2fs > target %.2fs' % (result['latency'], rate_controller['target_latency']))
+                    log_rate_change(rate_controller, old_concurrency, old_delay, reason)
+        else:
+            rate_controller['concurrency'] = min(float(rate_controller['max_concurrency']),
+                rate_controller['concurrency'] + 1.0 / rate_controller['concurrency'])
+            rate_controller['delay'] = rate_controller['delay'] / 2.0 if rate_controller['delay'] > 0.05 else 0.0
+            if int(rate_controller['concurrency']) != old_concurrency or (old_delay > 0 and rate_controller['delay'] == 0):
+                log_rate_change(rate_controller, old_concurrency, old_delay, 'latency %.2fs within target' % result['latency'])
+
+        condition.notify_all()
+
+def log_rate_change(rate_controller, old_concurrency, old_delay, reason):
+    log.info('Cache warming rate: concurrency %d -> %d, delay %.2fs -> %.2fs (%s)' % (
+        old_concurrency, int(rate_controller['concurrency']), old_delay, rate_controller['delay'], reason))
+
+# conn: open keep-alive connection to the host, or None
+#
+# Requests a single path, retrying on connection errors and server errors.
+# Returns a tuple of (result dictionary as described in warm_urls(), connection
+# to re-use for the next request or None).
+def warm_url(host, conn, path, warm_options):
+    result = {'path': path, 'status': None, 'latency': None, 'attempts': 0, 'error': None}
+    for attempt in range(warm_options['retries'] + 1):
+        if attempt > 0:
+            time.sleep(min(2 ** attempt, 30))
+        result['attempts'] += 1
+        request_start_time = time.time()
+        try:
+            if conn is None:
+                conn = httplib.HTTPConnection(host, timeout=warm_options['timeout'])
+            conn.request('GET', path)
+            response = conn.getresponse()
+            # The response must be read in full before the connection can be re-used
+            response.read()
+            result['latency'] = time.time() - request_start_time
+            result['status'] = response.status
+            result['error'] = None
+            if response.will_close:
+                conn.close()
+                conn = None
+            if response.status < 500:
+                break
+
+        except (httplib.HTTPException, socket.error) as e:
+            result['error'] = e.__class__.__name__ + ': ' + str(e)
+            if conn is not None:
+                conn.close()
+                conn = None
+
+    return result, conn
+
+# Returns a one line summary of the given cache warming results
+def get_warm_summary(results):
+    ok_results = [r for r in results if r['status'] is not None and r['status'] < 400]
+    latencies = sorted([r['latency'] for r in ok_results])
+    summary = str(len(ok_results)) + ' of ' + str(len(results)) + ' URLs OK'
+    if len(latencies) > 0:
+        summary += ', latency mean %.2fs, median %.2fs, max %.2fs' % (
+            sum(latencies) / len(latencies), latencies[len(latencies) / 2], latencies[-1])
+    failed = [r['path'] + ' (' + str(r['status'] or r['error']) + ')' for r in results if r['status'] is None or r['status'] >= 400]
+    if len(failed) > 0:
+        summary += '; failed: ' + ', '.join(failed[:20]) + (' ...' if len(failed) > 20 else '')
+    return summary
 
 def get_single_column(db_conn, sql):
     cursor = db_conn.cursor()
@@ -1281,6 +3802,493 @@ def get_single_column(db_conn, sql):
     return result
 
 
+#-------------------------------------------------------------------------------
+# WATCH MODE
+#-------------------------------------------------------------------------------
+# Running 'upload_data.py watch' keeps the script running, uploading files as
+# they arrive in the new files directory rather than on the next scheduled run.
+# Files are uploaded once their size and modification time have stopped
+# changing, using the same stages (and archive and error directories) as a
+# normal run, with DB connections (from the pool) and an S3 session kept open
+# between uploads.
+# Changes are picked up with inotify where the pyinotify package is installed,
+# otherwise by polling the directory.
+
+WATCH_SECTION = 'Watch'
+
+def get_watch_options(config):
+    return {
+        'poll_interval': float(get_config_option(config, WATCH_SECTION, 'poll_interval', '5')),
+        'stable_seconds': float(get_config_option(config, WATCH_SECTION, 'stable_seconds', '10')),
+        'retry_seconds': float(get_config_option(config, WATCH_SECTION, 'retry_seconds', '30')),
+        'max_retry_seconds': float(get_config_option(config, WATCH_SECTION, 'max_retry_seconds', '900'))
+    }
+
+def watch_new_files(config, watch_dir, log_file_name):
+    watch_options = get_watch_options(config)
+    s3_bucket = get_s3_bucket(config)
+    cache_command = get_cache_command([sys.argv[0]])
+    file_watcher = new_file_watcher(watch_dir)
+    watch_metrics = new_watch_metrics()
+    pending_files = {}
+    processed_files = {}
+    watch_failures = {'count': 0, 'retry_at': 0}
+    changed_files = get_all_files(watch_dir)
+    log.info('Watching ' + watch_dir + ' for new files')
+    try:
+        while True:
+            recheck_files = []
+            stable_files = update_pending_files(pending_files, processed_files, changed_files, watch_options['stable_seconds'])
+            # files claimed by another uploader stay pending until it has moved them
+            upload_leases = None
+            if len(stable_files) > 0 and time.time() < watch_failures['retry_at']:
+                # backing off after a failed upload, the files stay pending
+                stable_files = []
+            if len(stable_files) > 0:
+                try:
+                    upload_leases = claim_upload_leases(config, stable_files)
+                    stable_files = upload_leases['files']
+                except Exception as e:
+                    log.error('Unable to claim upload leases')
+                    log.exception(e)
+                    record_watch_failure(watch_failures, watch_options, config, log_file_name)
+                    stable_files = []
+            if len(stable_files) > 0:
+                db_conn = None
+                share_paths = {}
+                try:
+                    batch_start_time = time.time()
+                    local_file_paths, share_paths, file_hashes = stage_files(config, stable_files)
+                    taxonomy_changes, sample_numbers = process_files(config, classify_files(local_file_paths), s3_bucket,
+                        share_paths, file_hashes)
+                    # uploaded files have been moved to the archive or error directory,
+                    # files left in place (skipped) aren't processed again until they change
+                    moved_files = [f for f in stable_files if not os.path.isfile(f)]
+                    if len(moved_files) > 0:
+                        record_watch_batch(watch_metrics, [pending_files[f] for f in moved_files], batch_start_time)
+                    for f in stable_files:
+                        if f not in moved_files:
+                            processed_files[f] = pending_files[f]['signature']
+                        del pending_files[f]
+                    db_conn = borrow_db_connection(db_pool)
+                    recheck_files = get_images_to_recheck(db_conn, processed_files)
+                    update_website_data(config, db_conn, taxonomy_changes, sample_numbers, cache_command, s3_bucket)
+                    if watch_failures['count'] > 0:
+                        log.info('Upload succeeded after ' + str(watch_failures['count']) + ' failed attempts')
+                        watch_failures['count'] = 0
+                        watch_failures['retry_at'] = 0
+                except Exception as e:
+                    log.error('Error uploading ' + str(len(stable_files)) + ' new files')
+                    log.exception(e)
+                    record_watch_failure(watch_failures, watch_options, config, log_file_name)
+                finally:
+                    remove_staged_files(share_paths)
+                    release_upload_leases(upload_leases)
+                    if db_conn is not None:
+                        return_db_connection(db_pool, db_conn)
+
+            changed_files = wait_for_changed_files(file_watcher, watch_options['poll_interval']) + recheck_files
+    finally:
+        close_file_watcher(file_watcher)
+
+# watch_failures: dictionary in the form {'count': consecutive failed attempts, 'retry_at': time to retry}
+#
+# Records a failed upload attempt in watch mode. The files are retried after a
+# delay which doubles with each failure in a row, up to max_retry_seconds. The
+# error notification is only sent for the first failure in a row, so an outage
+# doesn't send one on every retry.
+def record_watch_failure(watch_failures, watch_options, config, log_file_name):
+    global notification_msg
+    watch_failures['count'] += 1
+    retry_delay = min(watch_options['max_retry_seconds'], watch_options['retry_seconds'] * 2 ** (watch_failures['count'] - 1))
+    watch_failures['retry_at'] = time.time() + retry_delay
+    log.error('Upload failed ' + str(watch_failures['count']) + ' times in a row, will retry in %.0fs' % retry_delay)
+    if watch_failures['count'] == 1:
+        log.info('Sending error notification')
+        send_error_notification(log_file_name, config)
+    # don't report this batch's results with the next one
+    notification_msg = NOTIFICATION_HEADER
+
+# Removes skipped images of samples now in the database (however they were
+# added, e.g as placeholders by a geochemistry or taxonomy upload) from
+# processed_files, and returns them so they're processed again
+def get_images_to_recheck(db_conn, processed_files):
+    skipped_images = {}
+    for f in processed_files:
+        if classify_file(os.path.basename(f)) == 'image':
+            skipped_images.setdefault(get_image_sample_number(f), []).append(f)
+    if len(skipped_images) == 0:
+        return []
+
+    uploaded_samples = get_uploaded_sample_numbers(db_conn, skipped_images.keys())
+    recheck_files = [f for sample_number, image_paths in skipped_images.iteritems()
+        if sample_number.upper() in uploaded_samples for f in image_paths]
+    for f in recheck_files:
+        del processed_files[f]
+    return recheck_files
+
+# Returns a file watcher dictionary in the form
+#     {'dir': directory watched, 'notifier': pyinotify notifier or None if polling, 'changed': set of changed paths}
+def new_file_watcher(watch_dir):
+    try:
+        import pyinotify
+    except ImportError:
+        log.info('pyinotify not available, polling for new files')
+        return {'dir': watch_dir, 'notifier': None, 'changed': None}
+
+    changed = set()
+    watch_manager = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(watch_manager, default_proc_fun=lambda event: changed.add(event.pathname))
+    watch_manager.add_watch(watch_dir,
+        pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO,
+        rec=True, auto_add=True)
+    return {'dir': watch_dir, 'notifier': notifier, 'changed': changed}
+
+def close_file_watcher(file_watcher):
+    if file_watcher['notifier'] is not None:
+        file_watcher['notifier'].stop()
+
+# Waits up to timeout seconds for changes, then returns a list of the files
+# which may have changed
+def wait_for_changed_files(file_watcher, timeout):
+    notifier = file_watcher['notifier']
+    if notifier is None:
+        time.sleep(timeout)
+        return get_all_files(file_watcher['dir'])
+
+    if notifier.check_events(int(timeout * 1000)):
+        notifier.read_events()
+        notifier.process_events()
+    changed_files = []
+    for path in file_watcher['changed']:
+        # files written to a new directory before it was watched only show up as the directory
+        if os.path.isdir(path):
+            changed_files.extend(get_all_files(path))
+        else:
+            changed_files.append(path)
+    file_watcher['changed'].clear()
+    return changed_files
+
+# pending_files: dictionary of files waiting to be uploaded, in the form
+#     {file_path: {'first_seen': time, 'changed_at': time, 'signature': (size, mtime)}}
+# processed_files: dictionary of files already processed but left in place, in the form {file_path: (size, mtime)}
+# changed_files: list of files which may have changed
+#
+# Adds new or changed files to pending_files, and returns a list of the
+# pending files which haven't changed for at least stable_seconds.
+def update_pending_files(pending_files, processed_files, changed_files, stable_seconds):
+    now = time.time()
+    for file_path in changed_files:
+        if file_path not in pending_files:
+            pending_files[file_path] = {'first_seen': now, 'changed_at': now, 'signature': None}
+
+    stable_files = []
+    for file_path, pending in pending_files.items():
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            # moved or deleted before it was uploaded
+            del pending_files[file_path]
+            continue
+        signature = (stat.st_size, stat.st_mtime)
+        if processed_files.get(file_path) == signature:
+            del pending_files[file_path]
+        elif signature != pending['signature']:
+            pending['signature'] = signature
+            pending['changed_at'] = now
+        elif now - pending['changed_at'] >= stable_seconds:
+            stable_files.append(file_path)
+
+    return sorted(stable_files)
+
+# Returns an empty record of the files uploaded in watch mode
+def new_watch_metrics():
+    return {
+        'start_time': time.time(),
+        'file_count': 0,
+        'byte_count': 0,
+        'batch_count': 0
+    }
+
+# pending: list of the pending_files entries of the files uploaded
+#
+# Logs the latency from each file being seen to it being committed to the
+# database, and the throughput since watching started
+def record_watch_batch(watch_metrics, pending, batch_start_time):
+    commit_time = time.time()
+    latencies = [commit_time - p['first_seen'] for p in pending]
+    byte_count = sum([p['signature'][0] for p in pending])
+    watch_metrics['file_count'] += len(pending)
+    watch_metrics['byte_count'] += byte_count
+    watch_metrics['batch_count'] += 1
+    hours = max(commit_time - watch_metrics['start_time'], 1) / 3600.0
+
+    log.info('Uploaded ' + str(len(pending)) + ' files (%.1f MB) in %.1fs, latency from drop to commit mean %.1fs, max %.1fs'
+        % (byte_count / 1048576.0, commit_time - batch_start_time, sum(latencies) / len(latencies), max(latencies)))
+    log.info('Since watching started: ' + str(watch_metrics['file_count']) + ' files in ' + str(watch_metrics['batch_count'])
+        + ' uploads, %.1f files/hour, %.1f MB/hour' % (watch_metrics['file_count'] / hours, watch_metrics['byte_count'] / 1048576.0 / hours))
+
+#-------------------------------------------------------------------------------
+# VALIDATION
+#-------------------------------------------------------------------------------
+# Running 'upload_data.py validate [folder]' checks the files in the new files
+# directory (or the given folder) without uploading anything, so a large drop
+# can be checked before it's committed. Each file is run through the same
+# parsers as an upload, in parallel worker processes, and every problem found
+# is reported along with the line or cell it was found at. Nothing is read from
+# or written to the database or S3 and no files are moved, so checks which need
+# existing data (e.g whether an image's sample has been uploaded) aren't made.
+VALIDATE_SECTION = 'Validate'
+
+# Number of problems listed per file, the rest are just counted
+MAX_REPORTED_PROBLEMS = 100
+
+# Sample file columns which must be present for the rows to be uploaded
+SAMPLE_FILE_COLUMNS = ['SampleNumber', 'SurveyDate', 'Comments', 'ColourRgbHex', FEATURE_NAME_COLUMN]
+
+# Matches DNA sequence lines made up of IUPAC nucleotide codes and gaps
+DNA_SEQUENCE_LINE_RE = re.compile('^[ACGTURYKMSWBDHVN.-]+$', re.IGNORECASE)
+
+# Checks the files in the given folder, and logs a report of the problems found.
+# Warnings are reported too, but aren't counted as problems.
+# Returns the number of problems found.
+def validate_files(config, validate_dir):
+    start_time = time.time()
+    file_paths = [f for f in get_all_files(validate_dir) if classify_file(os.path.basename(f)) != 'thumbsdb']
+    # Largest first, so a big file isn't left running on its own at the end
+    file_paths.sort(key=os.path.getsize, reverse=True)
+    worker_count = min(int(get_config_option(config, VALIDATE_SECTION, 'workers', str(multiprocessing.cpu_count()))), len(file_paths))
+    log.info('Validating ' + str(len(file_paths)) + ' files in ' + validate_dir + ' using ' + str(max(1, worker_count)) + ' workers')
+
+    if worker_count > 1:
+        pool = multiprocessing.Pool(worker_count)
+        try:
+            results = pool.map(validate_file, file_paths, 1)
+        finally:
+            pool.terminate()
+    else:
+        results = map(validate_file, file_paths)
+
+    problem_count = 0
+    problem_file_count = 0
+    warning_count = 0
+    for file_path, file_problem_count, problems, file_warning_count, warnings in sorted(results):
+        if file_problem_count == 0 and file_warning_count == 0:
+            continue
+        problem_count += file_problem_count
+        warning_count += file_warning_count
+        if file_problem_count > 0:
+            problem_file_count += 1
+        log.warn(get_relative_path(file_path) + ': ' + str(file_problem_count) + ' problems, ' + str(file_warning_count) + ' warnings')
+        log_validation_problems(file_problem_count, problems, '')
+        log_validation_problems(file_warning_count, warnings, 'warning: ')
+
+    log.info('Validated ' + str(len(file_paths)) + ' files in ' + format_elapsed(start_time) + ', found '
+        + str(problem_count) + ' problems in ' + str(problem_file_count) + ' files, and ' + str(warning_count) + ' warnings')
+    return problem_count
+
+# Logs the given (location, problem) tuples, and the number of any more not listed
+def log_validation_problems(problem_count, problems, prefix):
+    for location, problem in problems:
+        log.warn('    ' + prefix + (location + ': ' if location != '' else '') + problem)
+    if problem_count > len(problems):
+        log.warn('    ...and ' + str(problem_count - len(problems)) + ' more')
+
+# Checks the given file with the parser for its type. Runs in a worker process,
+# so takes a single picklable argument.
+# Returns a tuple of (file path, number of problems found, list of up to
+# MAX_REPORTED_PROBLEMS (location, problem) tuples, number of warnings, list of
+# up to MAX_REPORTED_PROBLEMS (location, warning) tuples), where the location
+# is a line or cell, or '' for problems with the whole file. Warnings are
+# values which would be uploaded, but may not be what was meant.
+def validate_file(file_path):
+    problems = []
+    warnings = []
+    file_type = classify_file(os.path.basename(file_path))
+    try:
+        if file_type == 'feature':
+            validate_tablet_file(file_path, [FEATURE_NAME_COLUMN], problems, warnings)
+        elif file_type == 'sample':
+            validate_tablet_file(file_path, SAMPLE_FILE_COLUMNS, problems, warnings)
+        elif file_type == 'xls':
+            validate_xls_file(file_path, problems)
+        elif file_type == 'dna_sequence':
+            validate_dna_sequence_file(file_path, problems)
+        elif file_type == 'image':
+            validate_image_file(file_path, problems)
+        else:
+            problems.append(('', 'File name not recognised, it would be left in the new files directory'))
+    except Exception as e:
+        problems.append(('', 'Unable to read file: ' + str(e)))
+
+    return file_path, len(problems), problems[:MAX_REPORTED_PROBLEMS], len(warnings), warnings[:MAX_REPORTED_PROBLEMS]
+
+# Checks a tab delimited feature or sample file has the given columns, and that
+# each row has a value for each column and values in the expected formats
+def validate_tablet_file(file_path, required_columns, problems, warnings):
+    line_number = 1
+    row_count = 0
+    try:
+        for line_number, column_names, values in read_tablet_data_lines(file_path):
+            if row_count == 0:
+                for column_name in required_columns:
+                    if column_name not in column_names:
+                        problems.append(('line 1', 'Missing column ' + column_name))
+            row_count += 1
+
+            location = 'line ' + str(line_number)
+            if len(values) != len(column_names):
+                problems.append((location, str(len(values)) + ' values found for ' + str(len(column_names)) + ' columns'))
+
+            row = dict(zip(column_names, values))
+            remove_string_quotes(row)
+            check_tablet_row(row, location, problems, warnings)
+
+    except UnicodeDecodeError as e:
+        problems.append(('after line ' + str(line_number), 'Not UTF-8 text: ' + str(e)))
+
+    if row_count == 0:
+        problems.append(('', 'No data rows found'))
+
+# Adds a problem for each value in the given feature or sample file row which
+# isn't in the expected format. Survey dates not in the older day/month/year
+# format are passed straight to MySQL by the upload, which may accept them, so
+# those not in DATE_FORMAT are warnings.
+def check_tablet_row(row, location, problems, warnings):
+    if FEATURE_NAME_COLUMN in row and row[FEATURE_NAME_COLUMN] == '':
+        problems.append((location + ', ' + FEATURE_NAME_COLUMN, 'Missing feature name'))
+
+    sample_number = row.get('SampleNumber')
+    if sample_number is not None and not SAMPLE_NUMBER_RE.match(sample_number):
+        problems.append((location + ', SampleNumber', 'Unexpected sample number "' + sample_number + '"'))
+
+    survey_date = row.get('SurveyDate')
+    if survey_date is not None and DATE_NO_SECONDS_RE.match(survey_date):
+        # converted by the upload, which fails if it isn't a valid date
+        try:
+            datetime.strptime(survey_date, DATE_NO_SECONDS_FORMAT)
+        except ValueError:
+            problems.append((location + ', SurveyDate', 'Unexpected date "' + survey_date + '"'))
+    elif survey_date is not None:
+        try:
+            datetime.strptime(survey_date, DATE_FORMAT)
+        except ValueError:
+            warnings.append((location + ', SurveyDate', 'Unexpected date "' + survey_date + '", it would be uploaded as it is'))
+
+    for column_name in ['LocationLatitude', 'LocationLongitude']:
+        value = row.get(column_name, '')
+        try:
+            if value != '':
+                float(value)
+        except ValueError:
+            problems.append((location + ', ' + column_name, 'Unexpected coordinate "' + value + '"'))
+
+# Checks a spreadsheet is in one of the geochemistry or taxonomy formats, and
+# that its results can be read
+def validate_xls_file(file_path, problems):
+    xlrd = get_xlrd()
+    # xlrd can't handle formatting info from Excel 2007+ workbooks
+    is_xlsx_file = file_path.endswith('.xlsx')
+    workbook = xlrd.open_workbook(file_path, formatting_info=(not is_xlsx_file))
+    worksheet = workbook.sheet_by_index(0)
+    file_name = os.path.basename(file_path)
+    if is_nzgal_geochem(worksheet):
+        validate_geochem_rows(read_nzgal_geochem_worksheet(worksheet, file_name, workbook, problems), problems)
+    # UoW worksheets use formatted values, so we can only process them if in .xls format
+    elif not is_xlsx_file and is_uow_geochem(worksheet):
+        validate_geochem_rows(read_uow_geochem_worksheet(worksheet, file_name, workbook, problems), problems)
+    elif 'otu_id' in get_taxonomy_columns(worksheet)[0]:
+        validate_taxonomy_worksheet(worksheet, file_name, problems)
+    else:
+        problems.append(('', 'Not recognised as geochemistry or taxonomy results, it would be skipped'))
+
+def validate_geochem_rows(geochem_rows, problems):
+    if len([r for r in geochem_rows if r[0] is not None and len(r[1]) > 0]) == 0:
+        problems.append(('', 'No sample results found, it would be skipped'))
+
+# Checks a taxonomy worksheet has all the expected columns, and that the OTU
+# rows can be read
+def validate_taxonomy_worksheet(worksheet, file_name, problems):
+    taxonomy_columns, sample_columns = get_taxonomy_columns(worksheet)
+    for col_name, db_column_name in sorted(TAXONOMY_COLUMN_MAP.items()):
+        if db_column_name not in taxonomy_columns:
+            problems.append(('row 1', 'Missing column ' + col_name + ', the file would be skipped'))
+    if len(sample_columns) == 0:
+        problems.append(('row 1', 'No sample columns found, the file would be skipped'))
+    if len(problems) > 0:
+        return
+
+    for col_index in range(0, worksheet.ncols):
+        sample_number = TAXONOMY_SAMPLE_NUMBER_RE.match(str(worksheet.cell_value(0, col_index)))
+        if sample_number and sample_columns['P1.' + sample_number.group(1)] != col_index:
+            problems.append((get_cell_name(0, col_index), 'Duplicate column for sample P1.' + sample_number.group(1)
+                + ', only the one in cell ' + get_cell_name(0, sample_columns['P1.' + sample_number.group(1)]) + ' would be uploaded'))
+
+    otu_rows = {}
+    otu_id_column = taxonomy_columns['otu_id']
+    for row_index in range(1, worksheet.nrows):
+        otu_id = worksheet.cell_value(row_index, otu_id_column)
+        if isinstance(otu_id, basestring) and OTU_ID_RE.match(otu_id):
+            if otu_id in otu_rows:
+                problems.append((get_cell_name(row_index, otu_id_column), 'Duplicate OTU ID ' + otu_id
+                    + ', also at ' + get_cell_name(otu_rows[otu_id], otu_id_column)))
+            else:
+                otu_rows[otu_id] = row_index
+
+    taxonomy_updates = read_taxonomy_worksheet(worksheet, file_name, problems)
+    if len(taxonomy_updates['taxonomy_data']) == 0:
+        problems.append(('', 'No OTU rows found, the file would be skipped'))
+
+# Checks each FASTA record has a header in the '>OTU_123' form and a sequence
+# made up of nucleotide codes, and that no OTU appears twice
+def validate_dna_sequence_file(file_path, problems):
+    otu_lines = {}
+    otu_id = None
+    header_line_number = 0
+    sequence_length = 0
+    line_number = 0
+    with open_data_file(file_path) as f:
+        for line in f:
+            line_number += 1
+            line = line.strip()
+            if line.startswith('>'):
+                if header_line_number > 0 and sequence_length == 0:
+                    problems.append(('line ' + str(header_line_number), 'No DNA sequence for ' + otu_id))
+
+                otu_id_line = OTU_ID_LINE_RE.match(line)
+                otu_id = otu_id_line.group(1) if otu_id_line else line[:100]
+                if not otu_id_line:
+                    problems.append(('line ' + str(line_number), 'Unexpected FASTA header "' + otu_id + '"'))
+                elif otu_id in otu_lines:
+                    problems.append(('line ' + str(line_number), 'Duplicate OTU ID ' + otu_id
+                        + ', also at line ' + str(otu_lines[otu_id])))
+                else:
+                    otu_lines[otu_id] = line_number
+                header_line_number = line_number
+                sequence_length = 0
+
+            elif len(line) > 0:
+                if otu_id is None:
+                    problems.append(('line ' + str(line_number), 'DNA sequence found before first FASTA header'))
+                    otu_id = ''
+                elif not DNA_SEQUENCE_LINE_RE.match(line):
+                    problems.append(('line ' + str(line_number), 'Unexpected characters in DNA sequence of ' + otu_id))
+                sequence_length += len(line)
+
+    if header_line_number > 0 and sequence_length == 0:
+        problems.append(('line ' + str(header_line_number), 'No DNA sequence for ' + otu_id))
+    if len(otu_lines) == 0:
+        problems.append(('', 'No FASTA records found'))
+
+# Checks a photo which would be uploaded can be decoded, as by reduce_image()
+def validate_image_file(file_path, problems):
+    if IMAGE_FILE_RE.match(os.path.basename(file_path)).group(2) != 'BESTPHOTO':
+        return
+    from PIL import Image
+    image = Image.open(file_path)
+    image._getexif()
+    image.load()
+
 #-------------------------------------------------------------------------------
 # UTILITY FUNCTIONS
 #-------------------------------------------------------------------------------
@@ -1294,18 +4302,27 @@ def get_single_column(db_conn, sql):
 def get_tablet_data_rows(file_path):
 
     rows = []
+    for line_number, column_names, values in read_tablet_data_lines(file_path):
+        row = dict(zip(column_names, values))
+        # Values from files edited in Excel end up with surrounding quotes
+        remove_string_quotes(row)
+        rows.append(row)
+
+    return rows
+
+
+# Generator returning a (line number, column names, list of values) tuple for
+# each non-blank line after the first (column name) line of the given file
+def read_tablet_data_lines(file_path):
     with codecs.open( file_path, 'r', 'utf-8') as f:
         first_line = f.readline().strip()
         column_names = first_line.split('\t')
+        line_number = 1
         for line in f:
+            line_number += 1
             trimmed_line = line.strip()
             if len(trimmed_line) > 0:
-                row = dict(zip(column_names,line.strip().split('\t')))
-                # Values from files edited in Excel end up with surrounding quotes
-                remove_string_quotes(row)
-                rows.append(row)
-
-    return rows
+                yield line_number, column_names, trimmed_line.split('\t')
 
 
 # row: a map in the form {key => value,
@@ -1355,10 +4372,11 @@ def get_update_sql(id_col_name, id_value, table_name, value_map):
     return sql, value_map.values() + [id_value]
 
 # file_type: e.g 'Feature' or 'Sample'
+# elapsed: seconds taken to upload the files, or None
 # Adds file upload statistics to the email notification sent out for the upload.
-def add_upload_summary(file_type, files_uploaded, files_error, files_skipped):
+def add_upload_summary(file_type, files_uploaded, files_error, files_skipped, elapsed=None):
     indent = '  '
-    add_to_notification('\n' + file_type + ' file upload summary')
+    add_to_notification('\n' + file_type + ' file upload summary' + (' (%.1fs)' % elapsed if elapsed is not None else ''))
 
     add_to_notification(indent + 'Files uploaded: '+ str(len(files_uploaded)))
     add_file_list(indent*2, files_uploaded)
@@ -1372,6 +4390,31 @@ def add_upload_summary(file_type, files_uploaded, files_error, files_skipped):
         add_file_list(indent*2, files_skipped)
 
 
+# duplicate_files: dictionary in the form returned by find_uploaded_files()
+# Adds the files archived because they'd already been uploaded to the email
+# notification sent out for the upload.
+def add_duplicate_file_summary(duplicate_files):
+    indent = '  '
+    if len(duplicate_files) > 0:
+        add_to_notification('\nDuplicate file summary')
+        add_to_notification(indent + 'Files already uploaded, archived without changes: ' + str(len(duplicate_files)))
+        for file_path, upload in sorted(duplicate_files.iteritems()):
+            add_to_notification(indent*2 + get_relative_path(file_path) + ': same as ' + upload['file_name']
+                + ' uploaded ' + str(upload['uploaded_at']))
+
+# otu_match_counts: list of [file name, matched OTU count, unmatched OTU count]
+# Adds the DNA sequence files with OTUs that had no matching taxonomy record
+# to the email notification sent out for the upload.
+def add_dna_sequence_match_summary(otu_match_counts):
+    indent = '  '
+    unmatched = [f for f in otu_match_counts if f[2] > 0]
+    if len(unmatched) > 0:
+        add_to_notification(indent + 'Files with OTUs not matching any taxonomy record: ' + str(len(unmatched)))
+        for file_name, matched_count, unmatched_count in sorted(unmatched):
+            add_to_notification(indent*2 + get_relative_path(file_name) + ': ' + str(matched_count)
+                + ' matched, ' + str(unmatched_count) + ' unmatched')
+
+
 # Adds a list of files and the number of records retrieved from each to the
 # email notification sent out for the upload.
 def add_file_list(indent, file_list):
@@ -1430,6 +4473,96 @@ def get_sample_taxonomy(db_conn, sample_id, taxonomy_id):
     sql = 'select * from sample_taxonomy where sample_id=%s and taxonomy_id=%s'
     return get_db_row(db_conn, sql, [sample_id, taxonomy_id])
 
+# Executes the given statement once for each set of parameters in
+# sql_params_list, sending up to batch_size sets to the server at a time
+def execute_in_batches(cursor, sql, sql_params_list, batch_size):
+    for batch_start in xrange(0, len(sql_params_list), batch_size):
+        cursor.executemany(sql, sql_params_list[batch_start:batch_start + batch_size])
+
+# table_name: name of an existing table, e.g 'taxonomy'
+#
+# staged_tables: tables being staged together. Foreign keys referencing one of
+#                these are pointed at its staging table, so they follow it when
+#                it's renamed into place.
+#
+# Creates an empty copy of the given table named [table_name]_new, without its
+# secondary indexes or foreign keys ('create table like' doesn't copy foreign
+# keys anyway). Returns the list of 'add index' and 'add foreign key' clauses
+# needed to restore them. The foreign keys are left for MySQL to name, as the
+# live table's constraint names are still in use until the swap.
+def create_staging_table(cursor, table_name, staged_tables=[]):
+    staging_table = table_name + '_new'
+    cursor.execute('drop table if exists `' + staging_table + '`')
+    cursor.execute('create table `' + staging_table + '` like `' + table_name + '`')
+
+    cursor.execute('show index from `' + staging_table + '`')
+    columns = [i[0] for i in cursor.description]
+    indexes = {}
+    for row in cursor.fetchall():
+        index = dict(zip(columns, row))
+        if index['Key_name'] != 'PRIMARY':
+            column = '`' + index['Column_name'] + '`'
+            if index['Sub_part'] is not None:
+                column += '(' + str(index['Sub_part']) + ')'
+            key = (index['Key_name'], index['Non_unique'])
+            indexes.setdefault(key, []).append((index['Seq_in_index'], column))
+
+    index_clauses = []
+    for (key_name, non_unique), index_columns in sorted(indexes.items()):
+        index_type = 'index' if non_unique else 'unique index'
+        index_clauses.append('add ' + index_type + ' `' + key_name + '` (' + ','.join([c for i, c in sorted(index_columns)]) + ')')
+
+    if len(index_clauses) > 0:
+        cursor.execute('alter table `' + staging_table + '` ' + ', '.join(['drop index `' + k + '`' for k, n in indexes]))
+
+    cursor.execute(
+        'select k.constraint_name, k.column_name, k.referenced_table_name, k.referenced_column_name, r.update_rule, r.delete_rule'
+        ' from information_schema.key_column_usage k'
+        ' join information_schema.referential_constraints r on r.constraint_schema=k.constraint_schema'
+        '  and r.constraint_name=k.constraint_name and r.table_name=k.table_name'
+        ' where k.table_schema=database() and k.table_name=%s and k.referenced_table_name is not null'
+        ' order by k.constraint_name, k.ordinal_position', [table_name])
+    foreign_keys = {}
+    for constraint_name, column, referenced_table, referenced_column, update_rule, delete_rule in cursor.fetchall():
+        if referenced_table in staged_tables:
+            referenced_table += '_new'
+        foreign_key = foreign_keys.setdefault(constraint_name, {'columns': [], 'referenced_table': referenced_table,
+            'referenced_columns': [], 'update_rule': update_rule, 'delete_rule': delete_rule})
+        foreign_key['columns'].append('`' + column + '`')
+        foreign_key['referenced_columns'].append('`' + referenced_column + '`')
+
+    for constraint_name, foreign_key in sorted(foreign_keys.items()):
+        index_clauses.append('add foreign key (' + ','.join(foreign_key['columns']) + ') references `'
+            + foreign_key['referenced_table'] + '` (' + ','.join(foreign_key['referenced_columns']) + ')'
+            + ' on update ' + foreign_key['update_rule'] + ' on delete ' + foreign_key['delete_rule'])
+
+    return index_clauses
+
+# index_clauses: list of 'add index' and 'add foreign key' clauses as returned
+#                by create_staging_table()
+def add_table_indexes(cursor, table_name, index_clauses):
+    if len(index_clauses) > 0:
+        index_start_time = time.time()
+        cursor.execute('alter table `' + table_name + '` ' + ', '.join(index_clauses))
+        log.info('Built ' + str(len(index_clauses)) + ' indexes and foreign keys on ' + table_name + ' in ' + format_elapsed(index_start_time))
+
+# table_names: names of tables to be replaced by their [table_name]_new staging tables
+#
+# Swaps all the staging tables in with a single (atomic) rename, then drops the
+# replaced tables. Tables should be listed parents first, they are dropped in
+# reverse order so no table is dropped while another still references it.
+def swap_staging_tables(cursor, table_names):
+    renames = []
+    for table_name in table_names:
+        renames.append('`' + table_name + '` to `' + table_name + '_old`')
+        renames.append('`' + table_name + '_new` to `' + table_name + '`')
+
+    cursor.execute('drop table if exists ' + ', '.join(['`' + t + '_old`' for t in reversed(table_names)]))
+    cursor.execute('rename table ' + ', '.join(renames))
+    log.info('Swapped in new ' + ', '.join(table_names) + ' tables')
+    for table_name in reversed(table_names):
+        cursor.execute('drop table `' + table_name + '_old`')
+
 def get_db_row(db_conn, sql, sql_params):
     cursor = db_conn.cursor()
     try:
@@ -1443,14 +4576,29 @@ def get_db_row(db_conn, sql, sql_params):
         cursor.close()
 
 
-# sample_number: e.g 'P1.0025'
-# Inserts a sample record with just the sample number into the database's sample table
-def insert_dummy_sample(db_conn, cursor, sample_number):
+# sample_numbers: list of sample numbers, e.g ['P1.0023', 'P1.0025']
+# Returns the sample.id values of those samples in the database, in the form
+# {sample_number: sample_id}. Samples not in the database are left out.
+def get_sample_ids(cursor, sample_numbers, batch_size=1000):
+    sample_ids = {}
+    for batch_start in xrange(0, len(sample_numbers), batch_size):
+        batch = sample_numbers[batch_start:batch_start + batch_size]
+        cursor.execute('select sample_number, id from sample where sample_number in (' + ','.join(['%s'] * len(batch)) + ')', batch)
+        sample_ids.update(cursor.fetchall())
+
+    return sample_ids
+
+# sample_numbers: list of sample numbers, e.g ['P1.0025', 'P1.0026']
+# Inserts sample records with just the sample numbers into the database's
+# sample table, using a single multi-row insert
+def insert_dummy_samples(cursor, sample_numbers):
+    sql_params = []
+    for sample_number in sample_numbers:
+        sql_params.extend([sample_number, 'Unknown'])
     cursor.execute(
-        'insert into sample (sample_number, date_gathered, sampler) values (%s, now(), %s)',
-        [sample_number, 'Unknown']
+        'insert into sample (sample_number, date_gathered, sampler) values ' + ','.join(['(%s, now(), %s)'] * len(sample_numbers)),
+        sql_params
         )
-    return db_conn.insert_id()
 
 def send_error_notification(log_file_name, config):
     try:
@@ -1479,6 +4627,8 @@ def send_upload_notification(config):
         'upload_stats_to_csv',
         config
         )
+    # start afresh for the next upload (in watch mode)
+    notification_msg = NOTIFICATION_HEADER
 
 
 def send_email(message, subject, email_to_config_key, config):
@@ -1505,6 +4655,8 @@ def send_email(message, subject, email_to_config_key, config):
 def get_relative_path(file_name):
     if (file_name.startswith(new_files_dir)):
         return file_name[len(new_files_dir) + 1:]
+    elif staging_dir is not None and file_name.startswith(staging_dir):
+        return file_name[len(staging_dir) + 1:]
     else:
         return file_name
 
@@ -1554,28 +4706,154 @@ def init_logging(config):
 
     return fh
 
+# Returns the spreadsheet name of the cell at the given (zero based) row and
+# column, e.g 'C7' for row 6, column 2
+def get_cell_name(row_index, col_index):
+    return get_xlrd().cellname(row_index, col_index)
+
+# Returns the value of the given config option, or default_value if the option
+# (or its section) is missing from the config file
+def get_config_option(config, section, option, default_value):
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return default_value
+
+# Returns the time since start_time in a form suitable for logging, e.g '12.3s'
+def format_elapsed(start_time):
+    return '%.1fs' % (time.time() - start_time)
+
 def load_config(config_file):
     script_dir = os.path.dirname(os.path.realpath(__file__))
     config = ConfigParser.ConfigParser()
     config.read(os.path.join(script_dir, config_file))
     return config
 
+# Returns the Amazon S3 bucket that images and other website content is uploaded to
+def get_s3_bucket(config):
+    from boto.s3.connection import S3Connection
+    image_config = 'ImageProcessing'
+    s3_conn = S3Connection(
+        config.get(image_config, 'aws_access_key_id'),
+        config.get(image_config, 'aws_secret_access_key')
+        )
+    return s3_conn.get_bucket(config.get(image_config, 's3_bucket_name'))
+
+DB_SECTION = 'DB'
+
 def db_connect(config):
-    db_section = 'DB'
-    return MySQLdb.connect(
-        host=config.get(db_section, 'host'),
-        user=config.get(db_section, 'user'),
-        passwd=config.get(db_section, 'password'),
-        db=config.get(db_section, 'db'),
+    db_conn = MySQLdb.connect(
+        host=config.get(DB_SECTION, 'host'),
+        user=config.get(DB_SECTION, 'user'),
+        passwd=config.get(DB_SECTION, 'password'),
+        db=config.get(DB_SECTION, 'db'),
         charset='utf8',
         sql_mode='STRICT_ALL_TABLES'
         )
+    session_settings = get_config_option(config, DB_SECTION, 'session_settings', '').strip()
+    if session_settings != '':
+        cursor = db_conn.cursor()
+        cursor.execute('set session ' + session_settings)
+        cursor.close()
+    return db_conn
 
-def http_get(host, path):
+# Returns a new, empty DB connection pool, in the form
+#     {
+#        'config': config used to connect,
+#        'size': maximum number of idle connections kept open,
+#        'connect_retries': number of times a failed connection attempt is retried,
+#        'retry_delay': seconds before the first retry, doubled for each retry after,
+#        'max_retry_delay': maximum seconds between retries,
+#        'idle': list of idle connections,
+#        'lock': lock for the idle list
+#     }
+# Connections are borrowed with borrow_db_connection() and must be handed
+# back with return_db_connection(). More than 'size' connections can be
+# borrowed at once, the extra connections are closed when they're returned.
+def new_db_pool(config):
+    return {
+        'config': config,
+        'size': int(get_config_option(config, DB_SECTION, 'pool_size', '4')),
+        'connect_retries': int(get_config_option(config, DB_SECTION, 'connect_retries', '5')),
+        'retry_delay': float(get_config_option(config, DB_SECTION, 'retry_delay', '1')),
+        'max_retry_delay': float(get_config_option(config, DB_SECTION, 'max_retry_delay', '30')),
+        'idle': [],
+        'lock': threading.Lock()
+    }
+
+# Returns an idle connection from the pool, once it's checked it's still
+# alive, or a new connection if there are none
+def borrow_db_connection(db_pool):
+    while True:
+        with db_pool['lock']:
+            if len(db_pool['idle']) == 0:
+                break
+            db_conn = db_pool['idle'].pop()
+        try:
+            db_conn.ping()
+            return db_conn
+        except MySQLdb.Error as e:
+            log.info('Discarding dropped DB connection: ' + str(e))
+            close_db_connection(db_conn)
+
+    return connect_with_retry(db_pool)
+
+# Rolls back anything left uncommitted on the connection and keeps it for
+# reuse, unless the pool already has enough idle connections
+def return_db_connection(db_pool, db_conn):
+    try:
+        db_conn.rollback()
+    except MySQLdb.Error:
+        close_db_connection(db_conn)
+        return
+
+    with db_pool['lock']:
+        if len(db_pool['idle']) < db_pool['size']:
+            db_pool['idle'].append(db_conn)
+            return
+    db_conn.close()
+
+def close_db_pool(db_pool):
+    with db_pool['lock']:
+        idle = db_pool['idle']
+        db_pool['idle'] = []
+    for db_conn in idle:
+        close_db_connection(db_conn)
+
+# Closes the connection, ignoring errors from connections that have dropped
+def close_db_connection(db_conn):
+    try:
+        db_conn.close()
+    except MySQLdb.Error:
+        pass
+
+# Connects to the database, retrying with exponential backoff if the
+# database can't be reached
+def connect_with_retry(db_pool):
+    retry_delay = db_pool['retry_delay']
+    for attempt in range(db_pool['connect_retries'] + 1):
+        try:
+            return db_connect(db_pool['config'])
+        except MySQLdb.OperationalError as e:
+            if attempt == db_pool['connect_retries']:
+                raise
+            log.warn('Unable to connect to database (' + str(e) + '), retrying in %.1fs' % retry_delay)
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, db_pool['max_retry_delay'])
+
+# Requests the given path from the host, reading the response in full.
+# Returns the HTTP status code.
+def http_get(host, path, timeout=120):
     log.debug('HTTP get: http://' + host + path)
-    conn = httplib.HTTPConnection(host)
-    conn.request("GET", path)
-    return conn.getresponse()
+    conn = httplib.HTTPConnection(host, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        if response.status >= 400:
+            log.warn('HTTP get: http://' + host + path + ' returned ' + str(response.status))
+        return response.status
+    finally:
+        conn.close()
 
 MOUNT_SECTION = 'DataShare'
 def mount_data_share(config):
@@ -1614,15 +4892,46 @@ def get_sub_dir(config, dir_type):
     base_dir = mount_data_share(config)
     return os.path.join(base_dir, config.get(MOUNT_SECTION, dir_type))
 
+# Returns a list of the paths of all files in the given directory and its subdirectories
+def get_all_files(dir_path):
+    file_paths = []
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        for filename in filenames:
+            file_paths.append(os.path.join(dirpath, filename))
+    return file_paths
+
+# File types of compressed data files, which are read with open_data_file()
+COMPRESSED_FILE_TYPES = ['.gz', '.bz2']
+
+# Returns the file name without its directory or file type, e.g
+# 'C:\tmp\R1R2_Production.fasta.gz' -> 'R1R2_Production'
 def remove_file_type(file_name):
-    return os.path.splitext(os.path.basename(file_name))[0]
+    base_name, file_type = os.path.splitext(os.path.basename(file_name))
+    if file_type.lower() in COMPRESSED_FILE_TYPES:
+        base_name = os.path.splitext(base_name)[0]
+    return base_name
+
+# Opens the given file for reading, decompressing it on the fly if it's
+# a .gz or .bz2 file
+def open_data_file(file_path):
+    file_type = os.path.splitext(file_path)[1].lower()
+    if file_type == '.gz':
+        return gzip.open(file_path, 'rb')
+    elif file_type == '.bz2':
+        return bz2.BZ2File(file_path, 'r')
+    else:
+        return open(file_path)
 
-def move_files(file_list, output_dir):
+# share_paths: dictionary in the form {local copy: file on the share}, for files
+#              processed from local copies made by stage_files(), or None
+def move_files(file_list, output_dir, share_paths=None):
     for file_data in file_list:
         if isinstance(file_data, basestring):
             source_file = file_data
         else:
             source_file = file_data[0]
+        if share_paths is not None:
+            source_file = share_paths.get(source_file, source_file)
 
         target_file = os.path.join(output_dir, get_relative_path(source_file))
         folder = os.path.dirname(target_file)
@@ -1664,4 +4973,4 @@ def unmount_data_share(config):
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file